@@ -1,107 +1,168 @@
+import time
+_inicio_importacoes = time.perf_counter()
 import streamlit as st
 import pandas as pd
-import numpy as np
 import io
 import zipfile
-from typing import Optional
 import re
 from datetime import date, datetime
 import holidays
+import os
+import uuid
+import threading
+import json
+import hashlib
+from pathlib import Path
+from vr_armazem import GerenciadorArmazens
+from vr_explorador import ExploradorResultado, TAMANHOS_PAGINA
+from vr_historico import HistoricoResultados, ORIGEM_LOTE, codigo_competencia, competencia_anterior, rotulo_competencia
+from vr_jobs import GerenciadorJobs, FilaCheiaError, STATUS_ATIVOS, STATUS_NA_FILA, STATUS_CONCLUIDO
+from vr_calculo import (
+    calcular_totais, gerar_observacoes, anexar_valor_diario, definir_numero_processos,
+    calcular_dias_particionado, valorar_e_observar_particionado, calcular_matriz_dias,
+    pontuar_anomalias, identificar_casos_especiais, LIMIAR_ANOMALIA
+)
+# A pilha LangChain/Gemini só é importada quando a IA é usada (ver vr_ia.carregar_ia)
+import vr_ia
+from vr_ia import analisar_funcionario_ia
+TEMPO_IMPORTACOES_APP = time.perf_counter() - _inicio_importacoes
 
-# Importações atualizadas do LangChain
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.agents import AgentExecutor, create_structured_chat_agent
-from langchain import hub
-from langchain.tools import tool
-from langchain_community.callbacks.streamlit import StreamlitCallbackHandler
+# Diretório local para a fila de jobs e resultados persistidos
+DIRETORIO_CACHE = Path('.vr_cache')
+MAX_JOBS_SIMULTANEOS = 2
+# Orçamento de memória para as tabelas carregadas (por sessão e no servidor todo)
+ORCAMENTO_SESSAO_MB = 256
+ORCAMENTO_GLOBAL_MB = 1024
 
 # =====================================================================================
 # O "CÉREBRO" DO AGENTE: Função de identificação de ficheiros
 # =====================================================================================
-def identificar_arquivo(nome_arquivo, arquivo_bytes):
-    """Identifica o tipo de ficheiro com base nas suas colunas ou nome."""
+# Assinaturas de cabeçalho conhecidas, em ordem de prioridade:
+# (tipo, colunas obrigatórias, trechos que alguma coluna precisa conter)
+ASSINATURAS_CABECALHO = [
+    ("ATIVOS", frozenset({'TITULO DO CARGO', 'DESC. SITUACAO'}), ()),
+    ("FERIAS", frozenset({'DIAS DE FÉRIAS'}), ()),
+    ("DESLIGADOS", frozenset({'DATA DEMISSÃO', 'COMUNICADO DE DESLIGAMENTO'}), ()),
+    ("DIAS_UTEIS", frozenset({'SINDICADO'}), ()),
+    ("DIAS_UTEIS", frozenset({'SINDICATO', 'DIAS UTEIS'}), ()),
+    ("VALORES", frozenset({'VALOR'}), ('ESTADO',)),
+    ("EXTERIOR", frozenset({'CADASTRO', 'VALOR'}), ()),
+]
+# Quantas linhas do topo da planilha são examinadas à procura do cabeçalho
+LINHAS_PREVIEW_CABECALHO = 5
+CAMINHO_LAYOUTS_CONFIRMADOS = DIRETORIO_CACHE / 'layouts_confirmados.json'
+
+def normalizar_cabecalho(valores):
+    """Conjunto dos nomes de coluna não vazios, sem espaços nas pontas e em maiúsculas."""
+    return frozenset(str(valor).strip().upper() for valor in valores if pd.notna(valor) and str(valor).strip())
+
+def impressao_cabecalho(colunas):
+    """Impressão digital (hash) de um cabeçalho normalizado."""
+    return hashlib.sha1('|'.join(sorted(colunas)).encode('utf-8')).hexdigest()
+
+def casar_assinatura(colunas):
+    """Retorna o tipo da primeira assinatura satisfeita pelo cabeçalho, ou None."""
+    for tipo, obrigatorias, trechos in ASSINATURAS_CABECALHO:
+        if obrigatorias <= colunas and all(any(trecho in col for col in colunas) for trecho in trechos):
+            return tipo
+    return None
+
+@st.cache_resource
+def obter_layouts_confirmados():
+    """
+    Layouts já carregados com sucesso: {impressão do cabeçalho: tipo}. Um arquivo ilegível
+    conta como cache vazio: ele só acelera a identificação e é regravado na próxima
+    confirmação.
+    """
     try:
-        # Primeiro, tentar ler normalmente
-        df_preview = pd.read_excel(arquivo_bytes, nrows=10, engine='openpyxl')
-        
-        # Se a primeira linha contém títulos, tentar ler a partir da linha 2
-        if df_preview.iloc[0].astype(str).str.contains('BASE DIAS UTEIS', case=False, na=False).any():
-            df_preview = pd.read_excel(arquivo_bytes, header=1, nrows=5, engine='openpyxl')
-            if 'SINDICADO' in df_preview.columns or 'SINDICATO' in df_preview.columns:
-                return "DIAS_UTEIS"
-        
-        cols = {str(col).strip().upper() for col in df_preview.columns}
-        
-        if 'TITULO DO CARGO' in cols and 'DESC. SITUACAO' in cols: return "ATIVOS"
-        if 'DIAS DE FÉRIAS' in cols: return "FERIAS"
-        if 'DATA DEMISSÃO' in cols and 'COMUNICADO DE DESLIGAMENTO' in cols: return "DESLIGADOS"
-        if 'SINDICADO' in cols or ('SINDICATO' in cols and 'DIAS UTEIS' in cols): return "DIAS_UTEIS"
-        if 'VALOR' in cols and any('ESTADO' in col for col in cols): return "VALORES"
-        if 'CADASTRO' in cols and 'VALOR' in cols: return "EXTERIOR"
-        
-        nome_upper = nome_arquivo.upper()
-        if 'APRENDIZ' in nome_upper: return "APRENDIZ"
-        if 'ESTÁGIO' in nome_upper or 'ESTAGIO' in nome_upper: return "ESTAGIO"
-        if 'AFASTAMENTO' in nome_upper: return "AFASTAMENTOS"
-        if 'ADMISSÃO' in nome_upper: return "ADMITIDOS"
-        if 'DIAS UTEIS' in nome_upper or 'BASE DIAS' in nome_upper: return "DIAS_UTEIS"
+        layouts = json.loads(CAMINHO_LAYOUTS_CONFIRMADOS.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(layouts, dict):
+        return {}
+    # Versões anteriores gravavam [tipo, linha do cabeçalho]
+    return {impressao: valor[0] if isinstance(valor, list) else valor
+            for impressao, valor in layouts.items() if valor and isinstance(valor, (list, str))}
 
-        return "DESCONHECIDO"
-    except Exception as e:
-        st.write(f"Erro ao identificar arquivo {nome_arquivo}: {e}")
-        return "INVALIDO"
+@st.cache_resource
+def obter_lock_layouts():
+    """O dicionário de layouts é compartilhado por todas as sessões do servidor."""
+    return threading.Lock()
 
-def identificar_casos_especiais(df, mes_referencia, ano_referencia):
+def confirmar_layout(impressao, tipo):
+    """Memoriza o tipo de um layout que foi carregado sem erros, para os próximos uploads."""
+    layouts = obter_layouts_confirmados()
+    with obter_lock_layouts():
+        if layouts.get(impressao) == tipo:
+            return
+        layouts[impressao] = tipo
+        DIRETORIO_CACHE.mkdir(parents=True, exist_ok=True)
+        # Grava num temporário e troca de uma vez: quem lê nunca vê o arquivo pela metade
+        temporario = CAMINHO_LAYOUTS_CONFIRMADOS.with_name(f"{CAMINHO_LAYOUTS_CONFIRMADOS.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            temporario.write_text(json.dumps(layouts, ensure_ascii=False, indent=1), encoding='utf-8')
+            os.replace(temporario, CAMINHO_LAYOUTS_CONFIRMADOS)
+        finally:
+            temporario.unlink(missing_ok=True)
+
+def identificar_layout(nome_arquivo, arquivo_bytes):
     """
-    Usa lógica de pandas para identificar rapidamente funcionários que
-    precisam de uma análise mais detalhada da IA.
-    Retorna o DataFrame com uma nova coluna 'Motivo_Analise_IA'.
+    Identifica o tipo do ficheiro e a linha do cabeçalho lendo só as primeiras linhas.
+    Retorna (tipo, linha_cabecalho, impressao); `impressao` é None quando o tipo veio
+    do nome do ficheiro e não de uma assinatura de cabeçalho.
     """
-    df['Motivo_Analise_IA'] = ''
-    
-    # Regra 1: Pagamento zerado (excluindo demitidos na 1a quinzena)
-    demitido_1a_quinzena = (pd.to_datetime(df.get('DATA DEMISSÃO')).dt.month == mes_referencia) & \
-                           (pd.to_datetime(df.get('DATA DEMISSÃO')).dt.day <= 15) & \
-                           (df.get('COMUNICADO DE DESLIGAMENTO', '').str.upper() == 'OK')
-                           
-    pagamento_zerado_injustificado = (df['Dias_A_Pagar'] == 0) & (~demitido_1a_quinzena)
-    df.loc[pagamento_zerado_injustificado, 'Motivo_Analise_IA'] += 'Pagamento zerado; '
-
-    # Regra 2: Admitidos no mês de referência
-    admitidos_no_mes = (pd.to_datetime(df.get('Admissão')).dt.month == mes_referencia) & \
-                       (pd.to_datetime(df.get('Admissão')).dt.year == ano_referencia)
-    df.loc[admitidos_no_mes, 'Motivo_Analise_IA'] += 'Admissão recente; '
-    
-    # Regra 3: Desligados no mês de referência
-    desligados_no_mes = (pd.to_datetime(df.get('DATA DEMISSÃO')).dt.month == mes_referencia) & \
-                        (pd.to_datetime(df.get('DATA DEMISSÃO')).dt.year == ano_referencia)
-    df.loc[desligados_no_mes, 'Motivo_Analise_IA'] += 'Desligamento recente; '
-    
-    # Regra 4: Dados importantes ausentes que afetam o cálculo
-    if 'sindicato_ausente' in df.columns and df['sindicato_ausente'].any():
-        df.loc[df['sindicato_ausente'], 'Motivo_Analise_IA'] += 'Sindicato ausente; '
-        
-    if 'VALOR DIÁRIO VR' in df.columns and (df['VALOR DIÁRIO VR'] == 0).any():
-        df.loc[df['VALOR DIÁRIO VR'] == 0, 'Motivo_Analise_IA'] += 'Valor diário zerado; '
+    try:
+        topo = pd.read_excel(arquivo_bytes, header=None, nrows=LINHAS_PREVIEW_CABECALHO, engine='openpyxl')
+        candidatos = [(linha, normalizar_cabecalho(topo.iloc[linha])) for linha in range(len(topo))]
+
+        # 1) Layout já confirmado num upload anterior: busca direta pela impressão. O
+        # cabeçalho é a linha onde a impressão foi achada neste ficheiro, que pode estar
+        # em outra posição (com ou sem linha de título) no upload de outro mês
+        layouts = obter_layouts_confirmados()
+        for linha, colunas in candidatos:
+            impressao = impressao_cabecalho(colunas)
+            tipo = layouts.get(impressao)
+            if tipo:
+                return tipo, linha, impressao
+
+        # 2) Primeira linha (de cima para baixo) que satisfaz uma assinatura conhecida
+        for linha, colunas in candidatos:
+            tipo = casar_assinatura(colunas)
+            if tipo:
+                return tipo, linha, impressao_cabecalho(colunas)
 
-    return df
+        # 3) Fallback pelo nome; o cabeçalho é a primeira linha razoavelmente preenchida
+        linha_cabecalho = 0
+        if not topo.empty:
+            preenchidas = topo.notna().sum(axis=1)
+            linha_cabecalho = int((preenchidas >= max(2, preenchidas.max() // 2)).idxmax())
+
+        nome_upper = nome_arquivo.upper()
+        if 'APRENDIZ' in nome_upper: return "APRENDIZ", linha_cabecalho, None
+        if 'ESTÁGIO' in nome_upper or 'ESTAGIO' in nome_upper: return "ESTAGIO", linha_cabecalho, None
+        if 'AFASTAMENTO' in nome_upper: return "AFASTAMENTOS", linha_cabecalho, None
+        if 'ADMISSÃO' in nome_upper: return "ADMITIDOS", linha_cabecalho, None
+        if 'DIAS UTEIS' in nome_upper or 'BASE DIAS' in nome_upper: return "DIAS_UTEIS", linha_cabecalho, None
+
+        return "DESCONHECIDO", 0, None
+    except Exception as e:
+        st.write(f"Erro ao identificar arquivo {nome_arquivo}: {e}")
+        return "INVALIDO", 0, None
+
+def identificar_arquivo(nome_arquivo, arquivo_bytes):
+    """Identifica o tipo de ficheiro com base nas suas colunas ou nome."""
+    return identificar_layout(nome_arquivo, arquivo_bytes)[0]
 
 # =====================================================================================
 # NOVA FUNÇÃO DEDICADA PARA CARREGAR DIAS ÚTEIS
 # =====================================================================================
-def carregar_dias_uteis(arquivo_bytes):
+def carregar_dias_uteis(df_dias_uteis, saida=st):
     """
-    Carrega e processa a planilha de dias úteis de forma robusta.
-    Retorna um dicionário com {Sindicato: Dias}.
+    Processa a planilha de dias úteis (já carregada a partir da linha de cabeçalho
+    identificada no upload). Retorna um dicionário com {Sindicato: Dias}.
     """
     try:
-        # Tenta ler a partir da segunda linha (header=1), que é o caso mais comum
-        df = pd.read_excel(arquivo_bytes, header=1, engine='openpyxl')
-        
-        # Se a primeira coluna não tiver um nome (por causa de um título na primeira linha)
-        # os cabeçalhos podem estar errados. Tentamos ler de novo.
-        if 'Unnamed: 0' in df.columns:
-             df = pd.read_excel(arquivo_bytes, header=0, engine='openpyxl')
+        df = df_dias_uteis.copy()
 
         # Padronizar nomes das colunas (remove espaços, põe em maiúsculas)
         df.columns = [str(col).strip().upper() for col in df.columns]
@@ -125,7 +186,7 @@ def carregar_dias_uteis(arquivo_bytes):
         return dias_uteis_dict
 
     except Exception as e:
-        st.error(f"Erro Crítico ao processar a planilha de dias úteis: {e}")
+        saida.error(f"Erro Crítico ao processar a planilha de dias úteis: {e}")
         return None
 
 # =====================================================================================
@@ -177,14 +238,28 @@ def validar_e_corrigir_dados(df, tipo_arquivo):
     
     return df_limpo
 
+ESTADOS_FERIADOS = ['SP', 'RJ', 'RS', 'PR']
+
+@st.cache_data(show_spinner=False)
 def obter_feriados_brasil(ano, estado=None):
-    """Retorna os feriados nacionais e estaduais do Brasil para um ano específico."""
+    """Retorna os feriados nacionais e estaduais do Brasil para um ano específico.
+    O calendário é montado uma única vez por ano e estado (cache do Streamlit)."""
     feriados_br = holidays.Brazil(years=ano, state=estado)
     return list(feriados_br.keys())
 
-def consolidar_matriculas(dfs):
+def montar_periodo_referencia(ano_referencia, mes_referencia):
+    """Retorna o início e o fim do mês de referência e os feriados que caem nele."""
+    mes_inicio = pd.to_datetime(f'{ano_referencia}-{mes_referencia:02d}-01')
+    mes_fim = mes_inicio + pd.offsets.MonthEnd(0)
+    todos_feriados = set(obter_feriados_brasil(ano_referencia))
+    for estado in ESTADOS_FERIADOS:
+        todos_feriados.update(obter_feriados_brasil(ano_referencia, estado))
+    feriados_periodo = [f for f in todos_feriados if mes_inicio <= pd.to_datetime(f) <= mes_fim]
+    return mes_inicio, mes_fim, feriados_periodo
+
+def consolidar_matriculas(dfs, saida=st):
     """Consolida todas as matrículas de todos os arquivos em uma base única."""
-    st.write("🔄 **Passo 1: Consolidando todas as matrículas...**")
+    saida.write("🔄 **Passo 1: Consolidando todas as matrículas...**")
     
     # Lista de arquivos que contêm matrículas
     arquivos_com_matricula = ["ATIVOS", "ADMITIDOS", "DESLIGADOS", "FERIAS", "APRENDIZ", "ESTAGIO", "AFASTAMENTOS"]
@@ -200,27 +275,27 @@ def consolidar_matriculas(dfs):
         if key in dfs_validados and 'MATRICULA' in dfs_validados[key].columns:
             matriculas = dfs_validados[key]['MATRICULA'].dropna().unique()
             todas_matriculas.update(matriculas)
-            st.write(f"   - {key}: {len(matriculas)} matrículas")
+            saida.write(f"   - {key}: {len(matriculas)} matrículas")
     
     # Também incluir matrículas do arquivo EXTERIOR (coluna Cadastro)
     if "EXTERIOR" in dfs_validados and 'Cadastro' in dfs_validados["EXTERIOR"].columns:
         matriculas_exterior = dfs_validados["EXTERIOR"]['Cadastro'].dropna().unique()
         todas_matriculas.update(matriculas_exterior)
-        st.write(f"   - EXTERIOR: {len(matriculas_exterior)} matrículas")
+        saida.write(f"   - EXTERIOR: {len(matriculas_exterior)} matrículas")
     
     # Criar DataFrame consolidado
     master_df = pd.DataFrame(list(todas_matriculas), columns=['MATRICULA'])
     master_df['MATRICULA'] = master_df['MATRICULA'].astype(int)
     
-    st.success(f"✅ **Consolidação concluída: {len(master_df)} matrículas únicas encontradas**")
+    saida.success(f"✅ **Consolidação concluída: {len(master_df)} matrículas únicas encontradas**")
     
     return master_df, dfs_validados
 
-def aplicar_joins_sequenciais(master_df, dfs_validados):
+def aplicar_joins_sequenciais(master_df, dfs_validados, saida=st):
     """
     Aplica joins sequenciais e AGORA TAMBÉM AGREGA NOTAS DE COLUNAS SEM CABEÇALHO.
     """
-    st.write("🔗 **Passo 2: Aplicando joins sequenciais e capturando notas...**")
+    saida.write("🔗 **Passo 2: Aplicando joins sequenciais e capturando notas...**")
     
     prioridade_merge = ["ATIVOS", "ADMITIDOS", "DESLIGADOS", "FERIAS"]
     df_consolidado = master_df.copy()
@@ -233,7 +308,7 @@ def aplicar_joins_sequenciais(master_df, dfs_validados):
             # Coletar notas de colunas "Unnamed"
             colunas_unnamed = [col for col in df_fonte.columns if 'unnamed' in str(col).lower()]
             if colunas_unnamed:
-                st.write(f"   - 📝 Encontradas colunas de notas em '{arquivo}'")
+                saida.write(f"   - 📝 Encontradas colunas de notas em '{arquivo}'")
                 # Cria uma coluna de notas temporária no df_fonte
                 df_fonte['temp_notas'] = df_fonte[colunas_unnamed].astype(str).agg(' | '.join, axis=1)
                 # Limpa strings vazias ou de 'nan'
@@ -252,96 +327,26 @@ def aplicar_joins_sequenciais(master_df, dfs_validados):
             
             if len(colunas_para_merge) > 1:
                  df_consolidado = pd.merge(df_consolidado, df_fonte[colunas_para_merge], on='MATRICULA', how='left')
-                 st.write(f"   - Merged com {arquivo}: {len(colunas_para_merge)-1} colunas adicionadas")
+                 saida.write(f"   - Merged com {arquivo}: {len(colunas_para_merge)-1} colunas adicionadas")
     
     df_consolidado['Notas_Nao_Estruturadas'] = df_consolidado['Notas_Nao_Estruturadas'].str.strip()
-    st.success(f"✅ **Base consolidada criada com {len(df_consolidado)} registros**")
+    saida.success(f"✅ **Base consolidada criada com {len(df_consolidado)} registros**")
     return df_consolidado
 
-# =====================================================================================
-# FERRAMENTAS DO AGENTE DE IA
-# =====================================================================================
-
-@tool
-def analisar_funcionario_ia(dados_funcionario: str, motivo_analise: str, notas_nao_estruturadas: Optional[str] = None) -> str:
+def selecionar_elegiveis(dfs, saida=st):
     """
-    Analisa dados de um funcionário que foi pré-selecionado como um caso especial.
-    Usa o motivo da análise e notas não estruturadas para gerar observações inteligentes.
+    Executa os Passos 1 a 3: consolida as matrículas, aplica os joins e remove
+    os funcionários que se enquadram nas regras de exclusão.
+    Retorna (df_elegiveis, dfs_validados).
     """
-    try:
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-1.5-flash", 
-            temperature=0,
-            convert_system_message_to_human=True
-        )
-        
-        prompt = f"""
-        Você é um analista de RH especialista. Analise os dados de um funcionário que foi sinalizado como um caso especial.
-        Seu objetivo é gerar uma observação CONCISA e útil para a planilha de Vale Refeição.
-
-        **Motivo pelo qual este funcionário foi sinalizado para análise:**
-        {motivo_analise}
-
-        **Dados do Funcionário:**
-        {dados_funcionario}
-        """
-
-        if notas_nao_estruturadas and notas_nao_estruturadas.strip():
-            prompt += f"""
-        **Notas Manuais Encontradas na Planilha (informação crucial e não estruturada):**
-        "{notas_nao_estruturadas}"
-        """
-
-        prompt += """
-        **Sua Tarefa:**
-        Com base em TODAS as informações (motivo, dados e especialmente as notas manuais, se houver), gere uma observação curta (máximo 150 caracteres) que resuma a situação ou a ação necessária.
-        - Se as notas manuais explicarem o motivo (ex: "Pagamento zerado" e nota "Funcionário de licença"), use essa informação.
-        - Se não houver nada relevante a adicionar, retorne "SEM_OBSERVACAO".
-
-        Exemplos de boas observações:
-        - "Admissão em 15/05. Cálculo proporcional ok."
-        - "Pagamento zerado devido a licença não remunerada (ver nota)."
-        - "Desligado em 20/05. Comunicado OK. Pagamento proporcional."
-        - "Sindicato não localizado, valor padrão SP aplicado."
-        """
-        
-        response = llm.invoke(prompt)
-        observacao = response.content.strip()
-        
-        if len(observacao) > 150:
-            observacao = observacao[:147] + "..."
-            
-        return observacao if observacao != "SEM_OBSERVACAO" else ""
-        
-    except Exception as e:
-        return f"Erro na análise IA: {str(e)[:50]}"
-
-@tool
-def processar_calculo_vr() -> str:
-    """
-    Executa o processo completo de cálculo do Vale Refeição com validação de dados,
-    consolidação de matrículas, aplicação de regras de exclusão e cálculo detalhado.
-    A análise por IA para casos especiais é opcional.
-    """
-    dfs = st.session_state.get('dfs', {})
-    reference_date = st.session_state.get('reference_date', date(2025, 5, 1))
-    
-    # <-- MUDANÇA: Verifica se a análise de IA está habilitada
-    ai_enabled = st.session_state.get('ai_analysis_enabled', False)
-    
-    st.write("🚀 **Iniciando processamento completo do Vale Refeição**")
-    st.write(f"🤖 **Análise com IA para Casos Especiais:** {'ATIVADA' if ai_enabled else 'DESATIVADA'}")
-    st.write("=" * 60)
-    
     # --- PASSO 1: CONSOLIDAÇÃO DE MATRÍCULAS ---
-    master_df, dfs_validados = consolidar_matriculas(dfs)
-    
+    master_df, dfs_validados = consolidar_matriculas(dfs, saida)
+
     # --- PASSO 2: JOINS SEQUENCIAIS E CAPTURA DE NOTAS ---
-    df_consolidado = aplicar_joins_sequenciais(master_df, dfs_validados)
-    
-    # --- PASSO 3: APLICAÇÃO DAS REGRAS DE EXCLUSÃO (sem alterações) ---
-    st.write("❌ **Passo 3: Aplicando regras de exclusão...**")
-    # (O código do Passo 3 permanece o mesmo)
+    df_consolidado = aplicar_joins_sequenciais(master_df, dfs_validados, saida)
+
+    # --- PASSO 3: APLICAÇÃO DAS REGRAS DE EXCLUSÃO ---
+    saida.write("❌ **Passo 3: Aplicando regras de exclusão...**")
     matriculas_para_excluir = set()
     detalhes_exclusao = []
     if 'TITULO DO CARGO' in df_consolidado.columns:
@@ -374,126 +379,149 @@ def processar_calculo_vr() -> str:
         matriculas_para_excluir.update(matriculas_afastamentos)
         detalhes_exclusao.append(f"Afastamentos: {len(matriculas_afastamentos)} matrículas")
     df_elegiveis = df_consolidado[~df_consolidado['MATRICULA'].isin(matriculas_para_excluir)].copy()
-    st.write(f"   - Total de exclusões: {len(matriculas_para_excluir)} matrículas")
-    for detalhe in detalhes_exclusao: st.write(f"     • {detalhe}")
-    st.success(f"✅ **Restaram {len(df_elegiveis)} funcionários elegíveis**")
+    saida.write(f"   - Total de exclusões: {len(matriculas_para_excluir)} matrículas")
+    for detalhe in detalhes_exclusao: saida.write(f"     • {detalhe}")
+    saida.success(f"✅ **Restaram {len(df_elegiveis)} funcionários elegíveis**")
+
+    return df_elegiveis, dfs_validados
+
+# =====================================================================================
+# FUNÇÕES DE VALORAÇÃO E FORMATAÇÃO DO RESULTADO
+# =====================================================================================
+
+def preparar_tabela_valores(dfs_validados):
+    """Retorna a tabela de valores diários por estado, ou None se não houver arquivo VALORES."""
+    if "VALORES" not in dfs_validados:
+        return None
+    df_valores = dfs_validados["VALORES"].copy()
+    df_valores.columns = ['Estado', 'VALOR DIÁRIO VR']
+    return df_valores.dropna()
+
+# Colunas do layout final (origem -> nome na planilha), na ordem em que aparecem
+COLUNAS_LAYOUT_FINAL = {
+    'MATRICULA': 'Matricula', 'Admissão': 'Admissão', 'Sindicato': 'Sindicato do Colaborador',
+    'Competência': 'Competência', 'Dias_A_Pagar': 'Dias', 'VALOR DIÁRIO VR': 'VALOR DIÁRIO VR',
+    'TOTAL': 'TOTAL', 'Custo empresa': 'Custo empresa', 'Desconto profissional': 'Desconto profissional',
+    'OBS GERAL': 'OBS GERAL'
+}
+
+def formatar_resultado_final(df_final, mes_referencia, ano_referencia):
+    """
+    Gera o layout final da planilha de VR (Passo 9), com 'OBS GERAL' já preenchida.
+    O layout é montado numa única seleção de colunas, sem copiar nem alterar `df_final`.
+    """
+    colunas = {}
+    for origem, destino in COLUNAS_LAYOUT_FINAL.items():
+        if origem == 'Competência':
+            colunas[destino] = f"{mes_referencia:02d}/{ano_referencia}"
+        elif origem == 'Admissão' and origem in df_final.columns:
+            colunas[destino] = pd.to_datetime(df_final[origem], errors='coerce').dt.strftime('%d/%m/%Y')
+        elif origem in df_final.columns:
+            colunas[destino] = df_final[origem]
+    layout_final = pd.DataFrame(colunas, index=df_final.index)
+    layout_final = layout_final.sort_values('Matricula').reset_index(drop=True)
+    return layout_final
+
+def formatar_aba_vr(writer, df, sheet_name):
+    """Escreve uma aba no layout da planilha de VR, com formato monetário e larguras."""
+    df.to_excel(writer, index=False, sheet_name=sheet_name)
+
+    # Formatação
+    workbook  = writer.book
+    worksheet = writer.sheets[sheet_name]
+
+    # Formato monetário
+    money_format = workbook.add_format({'num_format': 'R$ #,##0.00'})
+
+    # Aplicar formato nas colunas de valor
+    colunas_valor = ['F', 'G', 'H', 'I']  # VALOR DIÁRIO VR, TOTAL, Custo empresa, Desconto profissional
+    for col in colunas_valor:
+        worksheet.set_column(f'{col}:{col}', 18, money_format)
+
+    # Ajustar largura das colunas
+    worksheet.set_column('A:A', 10)  # Matricula
+    worksheet.set_column('B:B', 12)  # Admissão
+    worksheet.set_column('C:C', 30)  # Sindicato
+    worksheet.set_column('D:D', 12)  # Competência
+    worksheet.set_column('E:E', 8)   # Dias
+    worksheet.set_column('J:J', 40)  # OBS GERAL
+
+# =====================================================================================
+# CÁLCULO COMPLETO DO VR
+# =====================================================================================
+
+def executar_calculo_vr(dfs, reference_date, ai_enabled=False, usar_planilha_dias_uteis=False, chave_particao='MATRICULA',
+                        limiar_anomalia=LIMIAR_ANOMALIA, somente_atipicos=True, saida=st):
+    """
+    Executa os Passos 1 a 9 do cálculo do Vale Refeição e retorna (layout_final, mensagem).
+    Não depende do estado da sessão: as mensagens de progresso vão para `saida`, que pode
+    ser o próprio `st` ou o relatório de um job em segundo plano.
+    """
+    saida.write("🚀 **Iniciando processamento completo do Vale Refeição**")
+    saida.write(f"🤖 **Análise com IA para Casos Especiais:** {'ATIVADA' if ai_enabled else 'DESATIVADA'}")
+    saida.write("=" * 60)
+    
+    # --- PASSOS 1 A 3: CONSOLIDAÇÃO, JOINS E REGRAS DE EXCLUSÃO ---
+    df_elegiveis, dfs_validados = selecionar_elegiveis(dfs, saida)
 
-    # --- PASSO 4: CONFIGURAÇÃO DO PERÍODO E FERIADOS (sem alterações) ---
-    st.write("📅 **Passo 4: Configurando período de referência e feriados...**")
+    # --- PASSO 4: CONFIGURAÇÃO DO PERÍODO E FERIADOS ---
+    saida.write("📅 **Passo 4: Configurando período de referência e feriados...**")
     ano_referencia = reference_date.year
     mes_referencia = reference_date.month
-    mes_inicio = pd.to_datetime(f'{ano_referencia}-{mes_referencia:02d}-01')
-    mes_fim = mes_inicio + pd.offsets.MonthEnd(0)
-    feriados_nacionais = obter_feriados_brasil(ano_referencia)
-    feriados_sp = obter_feriados_brasil(ano_referencia, 'SP')
-    feriados_rj = obter_feriados_brasil(ano_referencia, 'RJ')
-    feriados_rs = obter_feriados_brasil(ano_referencia, 'RS')
-    feriados_pr = obter_feriados_brasil(ano_referencia, 'PR')
-    todos_feriados = list(set(feriados_nacionais + feriados_sp + feriados_rj + feriados_rs + feriados_pr))
-    feriados_periodo = [f for f in todos_feriados if mes_inicio <= pd.to_datetime(f) <= mes_fim]
-    st.write(f"   - Período: {mes_inicio.strftime('%d/%m/%Y')} a {mes_fim.strftime('%d/%m/%Y')}")
-    st.write(f"   - Feriados no período: {len(feriados_periodo)}")
+    mes_inicio, mes_fim, feriados_periodo = montar_periodo_referencia(ano_referencia, mes_referencia)
+    saida.write(f"   - Período: {mes_inicio.strftime('%d/%m/%Y')} a {mes_fim.strftime('%d/%m/%Y')}")
+    saida.write(f"   - Feriados no período: {len(feriados_periodo)}")
 
     # --- PASSO 5: USAR DIAS ÚTEIS DA PLANILHA BASE (lógica já opcional, sem alterações) ---
     # (O código do Passo 5 permanece o mesmo)
     usar_dias_uteis_base = False
     dias_uteis_por_sindicato = {}
-    calculation_mode = st.session_state.get('calculation_mode', 'Calcular dinamicamente (Padrão)')
-    if calculation_mode == "Usar planilha 'Base dias uteis.xlsx'" and "DIAS_UTEIS" in st.session_state.dfs:
-        st.write("📋 **Passo 5: Processando planilha 'Base dias uteis.xlsx'...**")
-        arquivo_dias_uteis_info = next((f for f in st.session_state.file_uploader if "dias uteis" in f.name.lower() or "base dias" in f.name.lower()), None)
-        if arquivo_dias_uteis_info:
-            dias_uteis_por_sindicato = carregar_dias_uteis(arquivo_dias_uteis_info)
+    if usar_planilha_dias_uteis:
+        saida.write("📋 **Passo 5: Processando planilha 'Base dias uteis.xlsx'...**")
+        if "DIAS_UTEIS" in dfs:
+            dias_uteis_por_sindicato = carregar_dias_uteis(dfs["DIAS_UTEIS"], saida)
             if dias_uteis_por_sindicato:
                 usar_dias_uteis_base = True
-                st.success(f"   - ✅ Planilha de dias úteis carregada com sucesso para {len(dias_uteis_por_sindicato)} sindicatos.")
+                saida.success(f"   - ✅ Planilha de dias úteis carregada com sucesso para {len(dias_uteis_por_sindicato)} sindicatos.")
             else:
-                st.warning("⚠️ Planilha 'Base dias uteis.xlsx' não pôde ser processada. Usando cálculo dinâmico.")
+                saida.warning("⚠️ Planilha 'Base dias uteis.xlsx' não pôde ser processada. Usando cálculo dinâmico.")
         else:
-             st.warning("⚠️ Planilha 'Base dias uteis.xlsx' não encontrada nos arquivos. Usando cálculo dinâmico.")
+             saida.warning("⚠️ Planilha 'Base dias uteis.xlsx' não encontrada nos arquivos. Usando cálculo dinâmico.")
     else:
-        st.write("📋 **Passo 5: Usando cálculo dinâmico de dias úteis.**")
+        saida.write("📋 **Passo 5: Usando cálculo dinâmico de dias úteis.**")
 
 
     # --- PASSO 6: CÁLCULO DOS DIAS ---
-    st.write("🧮 **Passo 6: Calculando dias de benefício...**")
+    saida.write("🧮 **Passo 6: Calculando dias de benefício...**")
     
-    def calcular_dias_trabalhados(funcionario):
-        """Calcula os dias trabalhados com a NOVA LÓGICA DE FÉRIAS."""
-        
-        # Se a base de dias úteis for usada, a lógica de férias é um simples desconto
-        if usar_dias_uteis_base and 'Sindicato' in funcionario and pd.notna(funcionario['Sindicato']):
-            sindicato_func = str(funcionario['Sindicato']).strip()
-            for sind_base, dias_base in dias_uteis_por_sindicato.items():
-                if sind_base.upper() in sindicato_func.upper():
-                    # Lógica simples de desconto, pois a base já define o total
-                    dias_ferias = funcionario.get('DIAS DE FÉRIAS', 0)
-                    return max(0, dias_base - dias_ferias)
-        
-        # --- CÁLCULO DINÂMICO COM NOVA LÓGICA DE FÉRIAS ---
-        data_admissao = pd.to_datetime(funcionario.get('Admissão', pd.NaT), errors='coerce')
-        data_demissao = pd.to_datetime(funcionario.get('DATA DEMISSÃO', pd.NaT), errors='coerce')
-        comunicado_ok = str(funcionario.get('COMUNICADO DE DESLIGAMENTO', '')).strip().upper() == 'OK'
-        dias_ferias = funcionario.get('DIAS DE FÉRIAS', 0)
-        if pd.isna(dias_ferias): dias_ferias = 0
-        
-        # Período base do mês
-        inicio_calculo_base = mes_inicio
-        fim_calculo = mes_fim
-        
-        # <-- NOVA LÓGICA DE FÉRIAS: Desconta dias corridos do início do mês
-        if dias_ferias > 0:
-            # O trabalho só começa após o término das férias
-            # Adiciona (dias-1) ao dia 1 para achar o último dia de férias
-            # e +1 para achar o primeiro dia de trabalho
-            inicio_apos_ferias = mes_inicio + pd.Timedelta(days=dias_ferias)
-            inicio_calculo_base = max(inicio_calculo_base, inicio_apos_ferias)
-
-        # Ajustar por data de admissão (pega o maior entre início pós-férias e admissão)
-        if pd.notna(data_admissao):
-            inicio_calculo = max(inicio_calculo_base, data_admissao)
-        else:
-            inicio_calculo = inicio_calculo_base
-
-        # Ajustar por data de demissão
-        if pd.notna(data_demissao):
-            if comunicado_ok and data_demissao.day <= 15 and data_demissao.month == mes_referencia:
-                return 0  # Não paga nada
-            fim_calculo = min(data_demissao, mes_fim)
-        
-        # Validação final do período
-        if inicio_calculo > fim_calculo:
-            return 0
-        
-        dias_uteis = np.busday_count(
-            inicio_calculo.strftime('%Y-%m-%d'),
-            (fim_calculo + pd.Timedelta(days=1)).strftime('%Y-%m-%d'),
-            holidays=[f.strftime('%Y-%m-%d') for f in feriados_periodo]
-        )
-
-        # A LÓGICA DE SUBTRAÇÃO NO FINAL FOI REMOVIDA
-        return int(max(0, dias_uteis))
-
-    df_elegiveis['Dias_A_Pagar'] = df_elegiveis.apply(calcular_dias_trabalhados, axis=1)
+    n_processos = definir_numero_processos(len(df_elegiveis))
+    if n_processos > 1:
+        saida.write(f"   - Base grande: dividindo o cálculo em {n_processos} processos paralelos (partições por {chave_particao})")
+    df_elegiveis['Dias_A_Pagar'] = calcular_dias_particionado(
+        df_elegiveis, n_processos, chave=chave_particao,
+        mes_inicio=mes_inicio, mes_fim=mes_fim, mes_referencia=mes_referencia, feriados_periodo=feriados_periodo,
+        dias_uteis_por_sindicato=dias_uteis_por_sindicato, usar_dias_uteis_base=usar_dias_uteis_base
+    )
 
     # --- PASSO 7: ANÁLISE IA (AGORA OPCIONAL) ---
     # Este bloco inteiro só será executado se o toggle estiver ligado
     if ai_enabled:
-        st.write("🤖 **Passo 7: Identificando casos especiais para análise com IA...**")
-        df_elegiveis = identificar_casos_especiais(df_elegiveis, mes_referencia, ano_referencia)
+        saida.write("🤖 **Passo 7: Identificando casos especiais para análise com IA...**")
+        anomalias = calcular_anomalias(df_elegiveis, dfs_validados, ano_referencia, mes_referencia, limiar_anomalia, saida)
+        df_elegiveis = identificar_casos_especiais(df_elegiveis, mes_referencia, ano_referencia, anomalias, limiar_anomalia, somente_atipicos)
         df_para_analise = df_elegiveis[df_elegiveis['Motivo_Analise_IA'] != ''].copy()
         total_a_analisar = len(df_para_analise)
-        st.write(f"   - {total_a_analisar} de {len(df_elegiveis)} funcionários selecionados para análise detalhada.")
+        saida.write(f"   - {total_a_analisar} de {len(df_elegiveis)} funcionários selecionados para análise detalhada.")
         
         observacoes_ia = {}
         if total_a_analisar > 0:
-            progress_bar = st.progress(0, text=f"Analisando {total_a_analisar} casos especiais...")
+            progress_bar = saida.progress(0, text=f"Analisando {total_a_analisar} casos especiais...")
             for idx, (matricula, funcionario) in enumerate(df_para_analise.iterrows()):
                 dados_formatados = f"- Matrícula: {funcionario.get('MATRICULA', 'N/A')}\n- Cargo: {funcionario.get('TITULO DO CARGO', 'N/A')}\n- Situação: {funcionario.get('DESC. SITUACAO', 'N/A')}\n- Admissão: {funcionario.get('Admissão', 'N/A')}\n- Demissão: {funcionario.get('DATA DEMISSÃO', 'N/A')}\n- Dias Calculados: {funcionario.get('Dias_A_Pagar', 'N/A')}"
                 motivo = funcionario['Motivo_Analise_IA']
                 notas = funcionario.get('Notas_Nao_Estruturadas', '')
                 try:
-                    observacao = analisar_funcionario_ia.invoke({"dados_funcionario": dados_formatados, "motivo_analise": motivo, "notas_nao_estruturadas": notas})
+                    observacao = analisar_funcionario_ia(dados_formatados, motivo, notas)
                     observacoes_ia[matricula] = observacao
                 except Exception:
                     observacoes_ia[matricula] = "Erro na chamada da IA."
@@ -502,65 +530,402 @@ def processar_calculo_vr() -> str:
         df_elegiveis['Observacao_IA'] = df_elegiveis.index.map(observacoes_ia).fillna('')
     else:
         # Se a IA estiver desligada, cria a coluna vazia para evitar erros
-        st.write("🤖 **Passo 7: Análise com IA desativada.**")
+        saida.write("🤖 **Passo 7: Análise com IA desativada.**")
         df_elegiveis['Observacao_IA'] = ''
 
 
-    # --- PASSO 8 E 9 (sem alterações) ---
-    # O código dos Passos 8 e 9 permanece o mesmo
-    st.write("💰 **Passo 8: Calculando valores do benefício...**")
-    if "VALORES" not in dfs_validados:
-        st.error("❌ Arquivo de valores não encontrado!")
-        return "Erro: Arquivo VALORES não encontrado"
-    df_valores = dfs_validados["VALORES"].copy()
-    df_valores.columns = ['Estado', 'VALOR DIÁRIO VR']
-    df_valores = df_valores.dropna()
-    def mapear_sindicato_estado(sindicato_text):
-        if not isinstance(sindicato_text, str): return 'São Paulo'
-        sindicato_upper = sindicato_text.upper()
-        if 'SP' in sindicato_upper or 'SÃO PAULO' in sindicato_upper: return 'São Paulo'
-        elif 'RJ' in sindicato_upper or 'RIO DE JANEIRO' in sindicato_upper: return 'Rio de Janeiro'
-        elif 'RS' in sindicato_upper or 'RIO GRANDE DO SUL' in sindicato_upper: return 'Rio Grande do Sul'
-        elif 'PR' in sindicato_upper or 'PARANÁ' in sindicato_upper: return 'Paraná'
-        else: return 'São Paulo'
-    df_final = df_elegiveis.copy()
-    df_final['sindicato_ausente'] = df_final['Sindicato'].isna()
-    df_final['Sindicato'] = df_final['Sindicato'].fillna('SINDPD SP - SIND.TRAB.EM PROC DADOS E EMPR.EMP...')
-    df_final['Estado'] = df_final['Sindicato'].apply(mapear_sindicato_estado)
-    df_final = pd.merge(df_final, df_valores, on='Estado', how='left')
-    df_final['VALOR DIÁRIO VR'] = df_final['VALOR DIÁRIO VR'].fillna(0)
-    df_final['TOTAL'] = df_final['Dias_A_Pagar'] * df_final['VALOR DIÁRIO VR']
-    df_final['Custo empresa'] = df_final['TOTAL'] * 0.80
-    df_final['Desconto profissional'] = df_final['TOTAL'] * 0.20
-    st.write("📋 **Passo 9: Formatando resultado final...**")
-    def gerar_observacao_completa(row):
-        obs_padrao = []
-        obs_ia = row.get('Observacao_IA', '')
-        if row['sindicato_ausente']: obs_padrao.append('Sindicato não informado; atribuído SP por padrão')
-        if row['VALOR DIÁRIO VR'] == 0: obs_padrao.append('Valor diário não encontrado para o estado')
-        if row['Dias_A_Pagar'] == 0 and pd.notna(row.get('DATA DEMISSÃO')):
-            if str(row.get('COMUNICADO DE DESLIGAMENTO', '')).strip().upper() == 'OK':
-                obs_padrao.append('Desligado até dia 15 com comunicado OK')
-        todas_obs = obs_padrao + ([obs_ia] if obs_ia and obs_ia.strip() else [])
-        return '; '.join(todas_obs)
-    df_final['OBS GERAL'] = df_final.apply(gerar_observacao_completa, axis=1)
-    df_final['Competência'] = f"{mes_referencia:02d}/{ano_referencia}"
-    if 'Admissão' in df_final.columns:
-        df_final['Admissão'] = pd.to_datetime(df_final['Admissão'], errors='coerce').dt.strftime('%d/%m/%Y')
-    colunas_finais = ['MATRICULA', 'Admissão', 'Sindicato', 'Competência', 'Dias_A_Pagar', 'VALOR DIÁRIO VR', 'TOTAL', 'Custo empresa', 'Desconto profissional', 'OBS GERAL']
-    colunas_existentes = [col for col in colunas_finais if col in df_final.columns]
-    layout_final = df_final[colunas_existentes].copy()
-    mapeamento_colunas = {'MATRICULA': 'Matricula', 'Admissão': 'Admissão', 'Sindicato': 'Sindicato do Colaborador', 'Competência': 'Competência', 'Dias_A_Pagar': 'Dias', 'VALOR DIÁRIO VR': 'VALOR DIÁRIO VR', 'TOTAL': 'TOTAL', 'Custo empresa': 'Custo empresa', 'Desconto profissional': 'Desconto profissional', 'OBS GERAL': 'OBS GERAL'}
-    layout_final = layout_final.rename(columns={k: v for k, v in mapeamento_colunas.items() if k in layout_final.columns})
-    layout_final = layout_final.sort_values('Matricula').reset_index(drop=True)
-    st.session_state.dfs['RESULTADO_FINAL'] = layout_final
-    st.write("=" * 60)
-    st.success(f"🎉 **PROCESSAMENTO CONCLUÍDO!**")
-    st.write(f"📊 **Resumo final:**")
-    st.write(f"   - Funcionários processados: {len(layout_final)}")
-    st.write(f"   - Valor total calculado: R$ {layout_final['TOTAL'].sum():,.2f}")
+    # --- PASSO 8: VALORES DO BENEFÍCIO ---
+    saida.write("💰 **Passo 8: Calculando valores do benefício...**")
+    df_valores = preparar_tabela_valores(dfs_validados)
+    if df_valores is None:
+        saida.error("❌ Arquivo de valores não encontrado!")
+        return None, "Erro: Arquivo VALORES não encontrado"
+    df_final = valorar_e_observar_particionado(df_elegiveis, df_valores, n_processos, chave=chave_particao)
+
+    # --- PASSO 9: LAYOUT FINAL ---
+    saida.write("📋 **Passo 9: Formatando resultado final...**")
+    layout_final = formatar_resultado_final(df_final, mes_referencia, ano_referencia)
+    registrar_no_historico(layout_final, ano_referencia, mes_referencia, 'calculo', saida)
+    saida.write("=" * 60)
+    saida.success(f"🎉 **PROCESSAMENTO CONCLUÍDO!**")
+    saida.write(f"📊 **Resumo final:**")
+    saida.write(f"   - Funcionários processados: {len(layout_final)}")
+    saida.write(f"   - Valor total calculado: R$ {layout_final['TOTAL'].sum():,.2f}")
     
-    return f"✅ Cálculo finalizado! {len(layout_final)} funcionários processados, valor total: R$ {layout_final['TOTAL'].sum():,.2f}"
+    return layout_final, f"✅ Cálculo finalizado! {len(layout_final)} funcionários processados, valor total: R$ {layout_final['TOTAL'].sum():,.2f}"
+
+def parametros_calculo_sessao():
+    """Lê da sessão do Streamlit os parâmetros de `executar_calculo_vr`."""
+    calculation_mode = st.session_state.get('calculation_mode', 'Calcular dinamicamente (Padrão)')
+    usar_planilha_dias_uteis = calculation_mode == "Usar planilha 'Base dias uteis.xlsx'" and "DIAS_UTEIS" in st.session_state.dfs
+    ai_enabled = st.session_state.get('ai_analysis_enabled', False) and GOOGLE_API_KEY is not None
+    if ai_enabled:
+        vr_ia.carregar_ia(GOOGLE_API_KEY)
+    return {
+        'dfs': {chave: df for chave, df in st.session_state.dfs.items() if chave != 'RESULTADO_FINAL'},
+        'reference_date': st.session_state.get('reference_date', date(2025, 5, 1)),
+        'ai_enabled': ai_enabled,
+        'usar_planilha_dias_uteis': usar_planilha_dias_uteis,
+        'chave_particao': st.session_state.get('chave_particao', 'MATRICULA'),
+        'limiar_anomalia': st.session_state.get('limiar_anomalia', LIMIAR_ANOMALIA),
+        'somente_atipicos': st.session_state.get('somente_atipicos', True),
+    }
+
+def processar_calculo_vr() -> str:
+    """
+    Executa o processo completo de cálculo do Vale Refeição com validação de dados,
+    consolidação de matrículas, aplicação de regras de exclusão e cálculo detalhado.
+    A análise por IA para casos especiais é opcional.
+    """
+    parametros = parametros_calculo_sessao()
+    layout_final, mensagem = executar_calculo_vr(**parametros)
+    if layout_final is not None:
+        st.session_state.dfs['RESULTADO_FINAL'] = layout_final
+        st.session_state.resultado_id = uuid.uuid4().hex[:12]
+        st.session_state.resultado_referencia = parametros['reference_date']
+    return mensagem
+
+# =====================================================================================
+# CÁLCULO EM LOTE: VÁRIAS COMPETÊNCIAS NUMA ÚNICA PASSAGEM
+# =====================================================================================
+
+def listar_competencias(data_inicio, data_fim):
+    """Retorna a lista de (ano, mês) entre as duas datas, inclusive."""
+    competencias = []
+    ano, mes = data_inicio.year, data_inicio.month
+    while (ano, mes) <= (data_fim.year, data_fim.month):
+        competencias.append((ano, mes))
+        ano, mes = (ano + 1, 1) if mes == 12 else (ano, mes + 1)
+    return competencias
+
+def processar_calculo_vr_lote(dfs, competencias, competencia_ferias):
+    """
+    Calcula o Vale Refeição de várias competências reaproveitando a base consolidada.
+    Os dias são sempre calculados dinamicamente e a análise com IA não é executada.
+    Os DIAS DE FÉRIAS carregados só valem para `competencia_ferias` (ano, mês), o mês de
+    referência a que a planilha de férias se refere.
+    Retorna {competência: layout final}, ou None se faltar o arquivo VALORES.
+    """
+    st.write(f"🚀 **Iniciando cálculo em lote para {len(competencias)} competências**")
+    st.write("=" * 60)
+
+    df_elegiveis, dfs_validados = selecionar_elegiveis(dfs)
+
+    st.write("💰 **Atribuindo valores diários por estado...**")
+    df_valores = preparar_tabela_valores(dfs_validados)
+    if df_valores is None:
+        st.error("❌ Arquivo de valores não encontrado!")
+        return None
+    df_elegiveis['Observacao_IA'] = ''
+    df_base = anexar_valor_diario(df_elegiveis, df_valores)
+
+    st.write("🧮 **Calculando a matriz de dias (funcionário × competência)...**")
+    periodos = {(ano, mes): montar_periodo_referencia(ano, mes) for ano, mes in competencias}
+    matriz_dias = calcular_matriz_dias(df_base, periodos, competencia_ferias)
+
+    st.write("📋 **Formatando resultado de cada competência...**")
+    resultados = {}
+    for ano_referencia, mes_referencia in competencias:
+        competencia = f"{mes_referencia:02d}/{ano_referencia}"
+        df_final = df_base.copy()
+        df_final['Dias_A_Pagar'] = matriz_dias[competencia]
+        df_final = gerar_observacoes(calcular_totais(df_final))
+        resultados[competencia] = formatar_resultado_final(df_final, mes_referencia, ano_referencia)
+        gravados = registrar_no_historico(resultados[competencia], ano_referencia, mes_referencia, ORIGEM_LOTE)
+        aviso = " (histórico mantido: competência já calculada individualmente)" if gravados == 0 and len(resultados[competencia]) else ""
+        st.write(f"   - {competencia}: R$ {resultados[competencia]['TOTAL'].sum():,.2f}{aviso}")
+
+    st.success(f"🎉 **Cálculo em lote concluído para {len(resultados)} competências!**")
+    return resultados
+
+def resumir_lote(resultados):
+    """Monta a tabela de resumo com os totais de cada competência."""
+    linhas = []
+    for competencia, layout_final in resultados.items():
+        linhas.append({
+            'Competência': competencia,
+            'Funcionários': len(layout_final),
+            'Dias': layout_final['Dias'].sum(),
+            'TOTAL': layout_final['TOTAL'].sum(),
+            'Custo empresa': layout_final['Custo empresa'].sum(),
+            'Desconto profissional': layout_final['Desconto profissional'].sum(),
+        })
+    return pd.DataFrame(linhas)
+
+def gerar_planilha_lote(resultados):
+    """Gera o xlsx do lote: uma aba 'Resumo' e uma aba por competência."""
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        resumo = resumir_lote(resultados)
+        resumo.to_excel(writer, index=False, sheet_name='Resumo')
+        money_format = writer.book.add_format({'num_format': 'R$ #,##0.00'})
+        writer.sheets['Resumo'].set_column('A:C', 14)
+        writer.sheets['Resumo'].set_column('D:F', 20, money_format)
+
+        for competencia, layout_final in resultados.items():
+            formatar_aba_vr(writer, layout_final, f"VR_{competencia.replace('/', '_')}")
+    return output.getvalue()
+
+# =====================================================================================
+# EXIBIÇÃO DE RESULTADOS
+# =====================================================================================
+
+# Quantos resultados cada sessão mantém prontos para exibição (explorador e planilha)
+MAX_RESULTADOS_EXIBIDOS = 2
+
+def obter_resultado_exibido(chave_resultado, obter_resultado):
+    """
+    Explorador Arrow (e planilha, gerada sob demanda) de um resultado, montados uma única
+    vez por resultado e guardados na sessão: não são compartilhados entre sessões e saem
+    da memória junto com ela. Retorna None se `obter_resultado` não encontrar o resultado.
+    """
+    exibidos = st.session_state.setdefault('resultados_exibidos', {})
+    if chave_resultado not in exibidos:
+        resultado = obter_resultado()
+        if resultado is None:
+            return None
+        while len(exibidos) >= MAX_RESULTADOS_EXIBIDOS:
+            exibidos.pop(next(iter(exibidos)))
+        exibidos[chave_resultado] = {'explorador': ExploradorResultado(resultado), 'planilha': None}
+    return exibidos[chave_resultado]
+
+def gerar_planilha_resultado(exibido, reference_date):
+    """Planilha xlsx do resultado, gerada uma única vez por resultado."""
+    if exibido['planilha'] is None:
+        output = io.BytesIO()
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+            formatar_aba_vr(writer, exibido['explorador'].para_pandas(), f"VR_{reference_date.strftime('%m_%Y')}")
+        exibido['planilha'] = output.getvalue()
+    return exibido['planilha']
+
+def exibir_pagina(explorador, chave, colunas=None, **filtros):
+    """Mostra uma página do explorador com o seletor de página e tamanho."""
+    col_pagina, col_tamanho = st.columns([3, 1])
+    with col_tamanho:
+        tamanho_pagina = st.selectbox("Linhas por página", TAMANHOS_PAGINA, index=1, key=f"{chave}_tamanho")
+    total_filtrado = explorador.contar(**filtros)
+    total_paginas = max(1, -(-total_filtrado // tamanho_pagina))
+    # Um filtro novo pode deixar a página atual fora do intervalo
+    if st.session_state.get(f"{chave}_pagina", 1) > total_paginas:
+        st.session_state[f"{chave}_pagina"] = 1
+    with col_pagina:
+        # Sem `value`: o valor vem só do Session State (que o reset acima também usa)
+        pagina = st.number_input(f"Página (de {total_paginas})", min_value=1, max_value=total_paginas, key=f"{chave}_pagina")
+    pagina_df, _ = explorador.consultar(pagina=pagina, tamanho_pagina=tamanho_pagina, colunas=colunas, **filtros)
+    st.dataframe(pagina_df, use_container_width=True, hide_index=True)
+    st.caption(f"{total_filtrado} de {explorador.total_linhas} funcionários")
+
+def exibir_resultado_final(obter_resultado, reference_date, chave):
+    """
+    Mostra métricas, tabela paginada, download e análise detalhada de um resultado de VR.
+    `obter_resultado` devolve o DataFrame e só é chamada na primeira exibição de `chave`.
+    """
+    exibido = obter_resultado_exibido(chave, obter_resultado)
+    if exibido is None:
+        st.error("❌ O resultado deste cálculo não está mais disponível (pode ter sido removido pela limpeza de jobs antigos). Execute o cálculo novamente.")
+        return
+    explorador = exibido['explorador']
+    metricas = explorador.metricas
+    st.subheader("📋 Resultado Final")
+
+    # Métricas principais
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Total de Funcionários", metricas['funcionarios'])
+    with col2:
+        st.metric("Valor Total VR", f"R$ {metricas['total']:,.2f}")
+    with col3:
+        st.metric("Custo Empresa", f"R$ {metricas['custo_empresa']:,.2f}")
+    with col4:
+        st.metric("Desconto Funcionários", f"R$ {metricas['desconto']:,.2f}")
+
+    # Tabela de resultados: filtros e ordenação no servidor, só a página vai para o navegador
+    col_busca, col_estado, col_ordem, col_sentido = st.columns([3, 2, 2, 1])
+    with col_busca:
+        busca = st.text_input("🔎 Buscar", placeholder="Matrícula, sindicato ou observação", key=f"{chave}_busca")
+    with col_estado:
+        estados = st.multiselect("Estado", explorador.estados, key=f"{chave}_estados")
+    with col_ordem:
+        ordenar_por = st.selectbox("Ordenar por", explorador.colunas, key=f"{chave}_ordem")
+    with col_sentido:
+        decrescente = st.toggle("Decrescente", key=f"{chave}_decrescente")
+    somente_com_obs = st.checkbox("Somente funcionários com observações", key=f"{chave}_obs")
+    exibir_pagina(explorador, f"{chave}_tabela", busca=busca, estados=estados, somente_com_obs=somente_com_obs,
+                  ordenar_por=ordenar_por, decrescente=decrescente)
+
+    # Download da planilha
+    st.download_button(
+        label=f"📥 Baixar Planilha Final VR {reference_date.strftime('%m/%Y')}",
+        data=gerar_planilha_resultado(exibido, reference_date),
+        file_name=f"VR_MENSAL_{reference_date.strftime('%m.%Y')}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        use_container_width=True,
+        key=f"download_{chave}"
+    )
+
+    # Análise adicional
+    with st.expander("📊 Análise Detalhada"):
+        st.write("**Distribuição por Estado:**")
+        if explorador.por_estado is not None:
+            st.dataframe(explorador.por_estado)
+
+        st.write("**Funcionários com Observações Especiais:**")
+        if metricas['com_observacao'] > 0:
+            exibir_pagina(explorador, f"{chave}_observacoes", colunas=['Matricula', 'OBS GERAL'], somente_com_obs=True)
+        else:
+            st.info("Nenhum funcionário com observações especiais.")
+
+# =====================================================================================
+# HISTÓRICO DE RESULTADOS
+# =====================================================================================
+
+@st.cache_resource
+def obter_historico():
+    """Banco de histórico único por servidor, compartilhado por todas as sessões."""
+    return HistoricoResultados(DIRETORIO_CACHE / 'historico')
+
+def registrar_no_historico(layout_final, ano_referencia, mes_referencia, origem, saida=st):
+    """
+    Grava o resultado no histórico e retorna o número de funcionários gravados; uma falha
+    aqui não invalida o cálculo (retorna None).
+    """
+    try:
+        return obter_historico().gravar(layout_final, ano_referencia, mes_referencia, origem)
+    except Exception as e:
+        saida.warning(f"⚠️ Não foi possível gravar a competência {mes_referencia:02d}/{ano_referencia} no histórico: {e}")
+        return None
+
+def calcular_anomalias(df_elegiveis, dfs_validados, ano_referencia, mes_referencia, limiar=LIMIAR_ANOMALIA, saida=st):
+    """
+    Pontua os desvios de cada funcionário em relação à competência anterior gravada no
+    histórico; são atípicos os que chegam a `limiar`. Competências gravadas pelo cálculo
+    em lote não servem de base. Retorna None se não houver com o que comparar.
+    """
+    anterior = competencia_anterior(codigo_competencia(ano_referencia, mes_referencia))
+    df_valores = preparar_tabela_valores(dfs_validados)
+    try:
+        df_anterior = obter_historico().resultado_competencia(anterior, incluir_lote=False)
+    except Exception as e:
+        saida.warning(f"⚠️ Não foi possível ler o histórico de {rotulo_competencia(anterior)}: {e}")
+        return None
+    if df_valores is None or df_anterior.empty:
+        saida.write(f"   - Sem resultado de {rotulo_competencia(anterior)} no histórico (fora os de cálculo em lote): todos os casos especiais vão para a IA.")
+        return None
+
+    anomalias = pontuar_anomalias(df_elegiveis, df_anterior, df_valores, limiar)
+    total_atipicos = int((anomalias['Pontuacao_Anomalia'] >= limiar).sum())
+    saida.write(f"   - Comparação com {rotulo_competencia(anterior)}: {total_atipicos} funcionários com variação atípica.")
+    return anomalias
+
+def exibir_historico(competencias):
+    """Painel de consultas ao histórico: resumo mensal, totais, funcionário e variações."""
+    historico = obter_historico()
+    aba_resumo, aba_totais, aba_funcionario, aba_variacao = st.tabs(
+        ["📅 Resumo Mensal", "🗺️ Por Estado / Sindicato", "👤 Funcionário", "🔀 Variação Mensal"]
+    )
+
+    with aba_resumo:
+        resumo = historico.resumo_mensal()
+        resumo['competencia'] = resumo['competencia'].map(rotulo_competencia)
+        st.dataframe(resumo.rename(columns={
+            'competencia': 'Competência', 'funcionarios': 'Funcionários', 'dias': 'Dias', 'total': 'TOTAL',
+            'custo_empresa': 'Custo empresa', 'desconto': 'Desconto profissional',
+            'delta_funcionarios': 'Δ Funcionários', 'delta_total': 'Δ TOTAL', 'delta_total_pct': 'Δ TOTAL (%)'
+        }), use_container_width=True, hide_index=True)
+
+    with aba_totais:
+        col_agrupamento, col_inicio, col_fim = st.columns(3)
+        codigos = sorted(competencias['competencia'])
+        with col_agrupamento:
+            agrupamento = st.radio("Agrupar por", ['estado', 'sindicato'], format_func=str.capitalize, horizontal=True, key="historico_agrupamento")
+        with col_inicio:
+            inicio = st.selectbox("De", codigos, format_func=rotulo_competencia, key="historico_inicio")
+        with col_fim:
+            fim = st.selectbox("Até", codigos, index=len(codigos) - 1, format_func=rotulo_competencia, key="historico_fim")
+        totais = historico.totais_por(agrupamento, inicio, fim)
+        if totais.empty:
+            st.info("Nenhuma competência no intervalo escolhido.")
+        else:
+            tabela = totais.pivot_table(index=agrupamento, columns='competencia', values='total', aggfunc='sum', fill_value=0)
+            tabela.columns = [rotulo_competencia(codigo) for codigo in tabela.columns]
+            st.dataframe(tabela.round(2), use_container_width=True)
+
+    with aba_funcionario:
+        matricula = st.text_input("Matrícula", key="historico_matricula")
+        if matricula:
+            historico_func = historico.historico_funcionario(matricula)
+            if historico_func.empty:
+                st.info(f"Nenhum resultado gravado para a matrícula {matricula}.")
+            else:
+                historico_func['competencia'] = historico_func['competencia'].map(rotulo_competencia)
+                st.line_chart(historico_func.set_index('competencia')['total'])
+                st.dataframe(historico_func, use_container_width=True, hide_index=True)
+
+    with aba_variacao:
+        competencia = st.selectbox("Competência", competencias['competencia'], format_func=rotulo_competencia, key="historico_variacao")
+        detalhes, contagem = historico.variacao_mensal(competencia)
+        st.caption(f"Comparação entre {rotulo_competencia(competencia)} e o mês anterior")
+        st.dataframe(contagem, use_container_width=True, hide_index=True)
+        if not detalhes.empty:
+            st.write(f"**Maiores variações ({len(detalhes)}):**")
+            st.dataframe(detalhes, use_container_width=True, hide_index=True)
+
+# =====================================================================================
+# ARMAZÉM DAS TABELAS DE SESSÃO
+# =====================================================================================
+
+@st.cache_resource
+def obter_gerenciador_armazens():
+    """Gerenciador único por servidor, para que o orçamento global valha entre sessões."""
+    return GerenciadorArmazens(DIRETORIO_CACHE / 'sessoes', orcamento_sessao_mb=ORCAMENTO_SESSAO_MB, orcamento_global_mb=ORCAMENTO_GLOBAL_MB)
+
+# =====================================================================================
+# CÁLCULOS EM SEGUNDO PLANO
+# =====================================================================================
+
+@st.cache_resource
+def obter_gerenciador_jobs():
+    """Fila de jobs única por servidor, compartilhada por todas as sessões."""
+    return GerenciadorJobs(DIRETORIO_CACHE / 'jobs', max_simultaneos=MAX_JOBS_SIMULTANEOS)
+
+def exibir_log_job(job_id):
+    """Reproduz, com os mesmos elementos do Streamlit, o log gravado pelo job."""
+    for tipo, texto in obter_gerenciador_jobs().eventos(job_id):
+        getattr(st, tipo)(texto)
+
+@st.fragment(run_every=2)
+def acompanhar_job(job_id):
+    """Mostra o progresso de um job ativo, atualizando a cada 2 segundos."""
+    job = obter_gerenciador_jobs().obter(job_id, st.session_state.dono_jobs)
+    if job is None or job['status'] not in STATUS_ATIVOS:
+        st.rerun()
+    if job['status'] == STATUS_NA_FILA:
+        st.info("⏳ Aguardando uma vaga na fila de processamento...")
+    else:
+        st.progress(job['progresso'] or 0.0, text=job['progresso_texto'] or "Processando...")
+    with st.expander("📜 Log do processamento", expanded=True):
+        exibir_log_job(job_id)
+
+def exibir_job(job_id):
+    """Mostra o estado e, se concluído, o resultado de um job em segundo plano."""
+    gerenciador = obter_gerenciador_jobs()
+    job = gerenciador.obter(job_id, st.session_state.dono_jobs)
+    if job is None:
+        st.warning(f"⚠️ Job {job_id} não encontrado.")
+        return
+    st.write(f"**{job['descricao']}** (job `{job_id}`, criado em {job['criado_em']})")
+    if job['status'] in STATUS_ATIVOS:
+        acompanhar_job(job_id)
+        return
+
+    with st.expander("📜 Log do processamento"):
+        exibir_log_job(job_id)
+    if job['status'] == STATUS_CONCLUIDO:
+        st.success(job['mensagem'])
+        reference_date = date.fromisoformat(job['metadados']['reference_date'])
+        exibir_resultado_final(lambda: gerenciador.carregar_resultado(job_id), reference_date, chave=f"job_{job_id}")
+    else:
+        st.error(f"❌ {job['mensagem']}")
 
 # =====================================================================================
 # INTERFACE DO STREAMLIT E LÓGICA DO AGENTE
@@ -569,17 +934,29 @@ def processar_calculo_vr() -> str:
 st.set_page_config(layout="wide", page_title="Agente de IA para Análise de VR - Versão Melhorada")
 st.title("🧠 Agente de IA para Automação de VR - Grupo Quantum - I2A2 (Com Gemini-2.5-Flash)")
 
-if 'dfs' not in st.session_state: 
-    st.session_state.dfs = {}
+# As tabelas da sessão ficam no armazém com orçamento de memória (spill para disco)
+if 'armazem_id' not in st.session_state:
+    st.session_state.armazem_id = uuid.uuid4().hex
+st.session_state.dfs = obter_gerenciador_armazens().obter(st.session_state.armazem_id)
+
+# Dono dos cálculos em segundo plano: um token aleatório guardado na URL, para que o
+# usuário reencontre os seus jobs ao recarregar a página e não veja os de outras sessões
+if 'dono_jobs' not in st.session_state:
+    token_url = st.query_params.get("sessao", "")
+    st.session_state.dono_jobs = token_url if re.fullmatch(r'[0-9a-f]{32}', token_url) else uuid.uuid4().hex
+if st.query_params.get("sessao") != st.session_state.dono_jobs:
+    st.query_params["sessao"] = st.session_state.dono_jobs
+if not st.session_state.dfs:
+    # Armazém novo (ou removido por ociosidade): os uploads precisam ser lidos de novo
+    st.session_state.pop('assinatura_uploads', None)
 if 'arquivos_processados_log' not in st.session_state: 
     st.session_state.arquivos_processados_log = {}
 
+# A chave só é necessária para a análise com IA e o modo agente; o cálculo funciona sem ela
 try:
     GOOGLE_API_KEY = st.secrets["GOOGLE_API_KEY"]
 except (FileNotFoundError, KeyError):
-    st.error("❌ Chave de API do Google não configurada nos secrets do Streamlit.")
-    st.info("Configure a chave GOOGLE_API_KEY nos secrets para usar o modelo Gemini-2.5-Flash")
-    st.stop()
+    GOOGLE_API_KEY = None
 
 col1, col2 = st.columns([1, 2])
 
@@ -608,15 +985,60 @@ with col1:
         key='calculation_mode',
         help="Se a planilha 'Base dias uteis.xlsx' for fornecida e esta opção selecionada, os dias dela terão prioridade."
     )
+    st.selectbox(
+        "Dividir bases grandes em processos por",
+        ('MATRICULA', 'Sindicato'),
+        key='chave_particao',
+        format_func=lambda chave: 'Matrícula' if chave == 'MATRICULA' else 'Sindicato',
+        help="Só vale para bases com mais de 100 mil funcionários. Por sindicato, cada processo recebe sindicatos inteiros; o resultado é o mesmo nas duas opções."
+    )
 
     st.subheader("4. Análise com IA")
+    if GOOGLE_API_KEY is None:
+        st.warning("⚠️ Chave GOOGLE_API_KEY não configurada nos secrets: a IA fica indisponível, mas o cálculo funciona normalmente.")
     st.toggle(
         "Ativar Análise com IA para Casos Especiais",
         key='ai_analysis_enabled',
         value=False,  # Inicia desligado por padrão
+        disabled=GOOGLE_API_KEY is None,
         help="Se ativado, a IA analisará funcionários com dados inconsistentes ou situações atípicas. Pode ser lento e consumir cotas da API."
     )
+    st.toggle(
+        "Modo Agente (Gemini orquestra o cálculo)",
+        key='agent_mode_enabled',
+        value=GOOGLE_API_KEY is not None,
+        disabled=GOOGLE_API_KEY is None,
+        help="Se desativado, o cálculo é executado diretamente, sem carregar o LangChain nem chamar o modelo."
+    )
+    if st.session_state.ai_analysis_enabled:
+        st.slider(
+            "Sensibilidade da comparação com o mês anterior",
+            min_value=2.0, max_value=6.0, value=LIMIAR_ANOMALIA, step=0.5,
+            key='limiar_anomalia',
+            help="Pontuação (escore z robusto) a partir da qual a variação de dias ou de valor em relação à competência anterior do histórico manda o funcionário para a IA. Valores menores enviam mais casos."
+        )
+        st.toggle(
+            "Enviar à IA só os casos atípicos em relação ao mês anterior",
+            key='somente_atipicos',
+            value=True,
+            help="Se ativado, os casos das regras (pagamento zerado, admissão, desligamento, dados ausentes) só vão para a IA quando não há histórico do mês anterior ou quando a variação de dias, valor ou sindicato é atípica. "
+                 "Desativado, todos os casos das regras vão para a IA, além dos atípicos (mais chamadas)."
+        )
 
+    st.subheader("5. Cálculo em Lote (opcional)")
+    st.toggle(
+        "Calcular várias competências de uma vez",
+        key='batch_mode_enabled',
+        value=False,
+        help="Reaproveita a base consolidada para calcular um intervalo de meses. Usa sempre o cálculo dinâmico de dias e não executa a análise com IA. "
+             "Os dias de férias da planilha carregada só são descontados na competência de referência (item 1); nos demais meses ninguém é considerado de férias."
+    )
+    if st.session_state.batch_mode_enabled:
+        lote_col1, lote_col2 = st.columns(2)
+        with lote_col1:
+            batch_start = st.date_input("Mês inicial", value=date(2025, 1, 1), min_value=date(2020, 1, 1), max_value=date(2030, 12, 31), format="DD/MM/YYYY")
+        with lote_col2:
+            batch_end = st.date_input("Mês final", value=reference_date, min_value=date(2020, 1, 1), max_value=date(2030, 12, 31), format="DD/MM/YYYY")
 
     # Informações sobre arquivos esperados
     with st.expander("📋 Arquivos Esperados"):
@@ -634,8 +1056,12 @@ with col1:
         st.write("- Funcionários no exterior")
         st.write("- Afastamentos gerais")
 
-if uploaded_files:
-    st.session_state.dfs, st.session_state.arquivos_processados_log = {}, {}
+# Só relê os ficheiros quando o conjunto enviado muda; nos demais reruns as tabelas já estão no armazém
+assinatura_uploads = tuple((file.name, file.size) for file in uploaded_files or [])
+if uploaded_files and assinatura_uploads != st.session_state.get('assinatura_uploads'):
+    st.session_state.dfs.clear()
+    st.session_state.arquivos_processados_log = {}
+    st.session_state.assinatura_uploads = assinatura_uploads
     arquivos_para_processar = []
     
     # Processar uploads
@@ -650,27 +1076,26 @@ if uploaded_files:
     
     # Identificar e carregar arquivos
     for nome, arquivo in arquivos_para_processar:
-        tipo = identificar_arquivo(nome, arquivo)
+        tipo, linha_cabecalho, impressao = identificar_layout(nome, arquivo)
         st.session_state.arquivos_processados_log[nome] = tipo
         if tipo not in ["DESCONHECIDO", "INVALIDO"]:
             try:
-                # Tratamento especial para arquivos com header na linha 2
-                if tipo == "DIAS_UTEIS":
-                    # Tentar carregar normalmente primeiro
-                    df_test = pd.read_excel(arquivo, nrows=2, engine='openpyxl')
-                    if df_test.iloc[0].astype(str).str.contains('BASE DIAS UTEIS', case=False, na=False).any():
-                        # Header está na linha 2
-                        st.session_state.dfs[tipo] = pd.read_excel(arquivo, header=1, engine='openpyxl')
-                    else:
-                        # Header está na linha 1
-                        st.session_state.dfs[tipo] = pd.read_excel(arquivo, engine='openpyxl')
-                else:
-                    st.session_state.dfs[tipo] = pd.read_excel(arquivo, engine='openpyxl')
+                # O cabeçalho é lido da linha identificada (planilhas com título no topo incluídas)
+                st.session_state.dfs[tipo] = pd.read_excel(arquivo, header=linha_cabecalho, engine='openpyxl')
+                if impressao:
+                    confirmar_layout(impressao, tipo)
             except Exception as e:
                 st.error(f"Erro ao carregar {nome}: {e}")
 
 with col2:
     with st.expander("🔍 Painel de Diagnóstico do Agente"):
+        st.write(f"⏱️ **Importações do app nesta execução:** {TEMPO_IMPORTACOES_APP:.2f}s")
+        if vr_ia.ia_carregada():
+            st.write(f"⏱️ **Pilha de IA (LangChain + Gemini):** {sum(vr_ia.METRICAS_IMPORTACAO.values()):.2f}s")
+            for modulo, segundos in vr_ia.METRICAS_IMPORTACAO.items():
+                st.write(f"   - {modulo}: {segundos:.2f}s")
+        else:
+            st.write("⏱️ **Pilha de IA (LangChain + Gemini):** não carregada")
         if not st.session_state.arquivos_processados_log: 
             st.write("Nenhum ficheiro processado.")
         else:
@@ -699,7 +1124,7 @@ with col2:
         st.markdown("**Obrigatórios**")
         for key in sorted(list(arquivos_obrigatorios)):
             if key in st.session_state.dfs: 
-                count = len(st.session_state.dfs[key])
+                count = st.session_state.dfs.linhas(key)
                 st.success(f"✅ {key} ({count} registros)")
             else: 
                 st.error(f"❌ {key}")
@@ -708,7 +1133,7 @@ with col2:
         st.markdown("**Opcionais**")
         for key in sorted(list(arquivos_opcionais)):
             if key in st.session_state.dfs: 
-                count = len(st.session_state.dfs[key])
+                count = st.session_state.dfs.linhas(key)
                 st.success(f"✅ {key} ({count} registros)")
                 if key == "DIAS_UTEIS":
                     st.info("🎯 Dias úteis serão priorizados!")
@@ -724,142 +1149,77 @@ if obrigatorios_ok:
     
     if "DIAS_UTEIS" in st.session_state.dfs:
         st.info("🎯 **Modo Especializado:** Utilizará a planilha 'Base dias uteis.xlsx' para cálculos precisos")
-    
-    if st.button("🚀 Executar Agente de IA", type="primary", use_container_width=True):
-        with st.spinner("🤖 O agente Gemini-2.5-Flash está analisando e processando..."):
-            try:
-                # Configurar ferramentas e modelo
-                tools = [processar_calculo_vr, analisar_funcionario_ia]
-                llm = ChatGoogleGenerativeAI(
-                    model="gemini-2.5-flash", 
-                    temperature=0,
-                    convert_system_message_to_human=True
-                )
-                
-                # Criar agente
-                prompt = hub.pull("hwchase17/structured-chat-agent")
-                agent = create_structured_chat_agent(llm, tools, prompt)
-                agent_executor = AgentExecutor(
-                    agent=agent, 
-                    tools=tools, 
-                    verbose=True, 
-                    handle_parsing_errors=True,
-                    max_iterations=3
-                )
-                
-                # Callback para mostrar progresso
-                st_callback = StreamlitCallbackHandler(st.container(), expand_new_thoughts=False)
-                
-                # Tarefa para o agente
-                task = f"""
-                Execute o cálculo completo do Vale Refeição para a competência {reference_date.strftime('%m/%Y')}.
-                Use a ferramenta 'processar_calculo_vr' para fazer todos os cálculos necessários.
-                O sistema já tem todos os arquivos carregados e validados.
-                Certifique-se de aplicar todas as regras de exclusão e usar a análise de IA quando apropriado.
-                """
-                
-                # Executar agente
-                response = agent_executor.invoke(
-                    {"input": task}, 
-                    {"callbacks": [st_callback]}
+
+    if st.session_state.batch_mode_enabled:
+        competencias_lote = listar_competencias(batch_start, batch_end)
+        if not competencias_lote:
+            st.warning("⚠️ O mês final do lote deve ser igual ou posterior ao mês inicial.")
+        elif st.button(f"📚 Executar Cálculo em Lote ({len(competencias_lote)} competências)", use_container_width=True):
+            with st.spinner("📚 Calculando as competências do lote..."):
+                resultados_lote = processar_calculo_vr_lote(st.session_state.dfs, competencias_lote, (reference_date.year, reference_date.month))
+            if resultados_lote:
+                st.subheader("📋 Resumo do Lote")
+                st.dataframe(resumir_lote(resultados_lote), use_container_width=True)
+                primeira, ultima = competencias_lote[0], competencias_lote[-1]
+                st.download_button(
+                    label=f"📥 Baixar Planilha do Lote {primeira[1]:02d}/{primeira[0]} a {ultima[1]:02d}/{ultima[0]}",
+                    data=gerar_planilha_lote(resultados_lote),
+                    file_name=f"VR_LOTE_{primeira[1]:02d}.{primeira[0]}_{ultima[1]:02d}.{ultima[0]}.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    use_container_width=True
                 )
-                
-                st.success("🎉 **Agente concluiu o processamento com sucesso!**")
-                
-                # Mostrar resultados
-                resultado_final_df = st.session_state.dfs.get('RESULTADO_FINAL')
-                
-                if resultado_final_df is not None:
-                    st.subheader("📋 Resultado Final")
-                    
-                    # Métricas principais
-                    col1, col2, col3, col4 = st.columns(4)
-                    with col1:
-                        st.metric("Total de Funcionários", len(resultado_final_df))
-                    with col2:
-                        st.metric("Valor Total VR", f"R$ {resultado_final_df['TOTAL'].sum():,.2f}")
-                    with col3:
-                        st.metric("Custo Empresa", f"R$ {resultado_final_df['Custo empresa'].sum():,.2f}")
-                    with col4:
-                        st.metric("Desconto Funcionários", f"R$ {resultado_final_df['Desconto profissional'].sum():,.2f}")
-                    
-                    # Tabela de resultados
-                    st.dataframe(resultado_final_df, use_container_width=True)
+
+    if st.button("⏳ Executar em Segundo Plano", use_container_width=True,
+                 help="Roda o cálculo numa fila do servidor. Você pode recarregar a página e voltar para acompanhar o resultado."):
+        try:
+            job_id = obter_gerenciador_jobs().submeter(
+                f"Cálculo VR {reference_date.strftime('%m/%Y')}",
+                executar_calculo_vr,
+                st.session_state.dono_jobs,
+                metadados={'reference_date': reference_date.isoformat()},
+                **parametros_calculo_sessao()
+            )
+            st.query_params["job"] = job_id
+        except FilaCheiaError as e:
+            st.warning(f"⚠️ {e}")
+
+    modo_agente = st.session_state.get('agent_mode_enabled', False) and GOOGLE_API_KEY is not None
+    rotulo_execucao = "🚀 Executar Agente de IA" if modo_agente else "🧮 Executar Cálculo"
+    if st.button(rotulo_execucao, type="primary", use_container_width=True):
+        texto_spinner = "🤖 O agente Gemini-2.5-Flash está analisando e processando..." if modo_agente else "🧮 Calculando o Vale Refeição..."
+        with st.spinner(texto_spinner):
+            try:
+                st.session_state.dfs.pop('RESULTADO_FINAL', None)
+                if modo_agente:
+                    vr_ia.carregar_ia(GOOGLE_API_KEY)
+
+                    # Tarefa para o agente
+                    task = f"""
+                    Execute o cálculo completo do Vale Refeição para a competência {reference_date.strftime('%m/%Y')}.
+                    Use a ferramenta 'processar_calculo_vr' para fazer todos os cálculos necessários.
+                    O sistema já tem todos os arquivos carregados e validados.
+                    Certifique-se de aplicar todas as regras de exclusão e usar a análise de IA quando apropriado.
+                    """
                     
-                    # Download da planilha
-                    output = io.BytesIO()
-                    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                        sheet_name = f"VR_{reference_date.strftime('%m_%Y')}"
-                        resultado_final_df.to_excel(writer, index=False, sheet_name=sheet_name)
-                        
-                        # Formatação
-                        workbook  = writer.book
-                        worksheet = writer.sheets[sheet_name]
-                        
-                        # Formato monetário
-                        money_format = workbook.add_format({'num_format': 'R$ #,##0.00'})
-                        
-                        # Aplicar formato nas colunas de valor
-                        colunas_valor = ['F', 'G', 'H', 'I']  # VALOR DIÁRIO VR, TOTAL, Custo empresa, Desconto profissional
-                        for col in colunas_valor:
-                            worksheet.set_column(f'{col}:{col}', 18, money_format)
-                        
-                        # Ajustar largura das colunas
-                        worksheet.set_column('A:A', 10)  # Matricula
-                        worksheet.set_column('B:B', 12)  # Admissão
-                        worksheet.set_column('C:C', 30)  # Sindicato
-                        worksheet.set_column('D:D', 12)  # Competência
-                        worksheet.set_column('E:E', 8)   # Dias
-                        worksheet.set_column('J:J', 40)  # OBS GERAL
-
-                    st.download_button(
-                        label=f"📥 Baixar Planilha Final VR {reference_date.strftime('%m/%Y')}",
-                        data=output.getvalue(),
-                        file_name=f"VR_MENSAL_{reference_date.strftime('%m.%Y')}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        use_container_width=True
-                    )
+                    # Executar agente
+                    response = vr_ia.executar_agente(processar_calculo_vr, task, st.container())
                     
-                    # Análise adicional
-                    with st.expander("📊 Análise Detalhada"):
-                        st.write("**Distribuição por Estado:**")
-                        if 'Sindicato do Colaborador' in resultado_final_df.columns:
-                            # Mapear sindicatos para estados para análise
-                            def extrair_estado(sindicato):
-                                if pd.isna(sindicato):
-                                    return 'Não informado'
-                                sindicato_upper = str(sindicato).upper()
-                                if 'SP' in sindicato_upper: return 'São Paulo'
-                                elif 'RJ' in sindicato_upper: return 'Rio de Janeiro'
-                                elif 'RS' in sindicato_upper: return 'Rio Grande do Sul'
-                                elif 'PR' in sindicato_upper: return 'Paraná'
-                                else: return 'Outros'
-                            
-                            resultado_final_df['Estado_Analise'] = resultado_final_df['Sindicato do Colaborador'].apply(extrair_estado)
-                            analise_estado = resultado_final_df.groupby('Estado_Analise').agg({
-                                'Matricula': 'count',
-                                'TOTAL': 'sum'
-                            }).rename(columns={'Matricula': 'Funcionários', 'TOTAL': 'Valor Total'})
-                            
-                            st.dataframe(analise_estado)
-                        
-                        st.write("**Funcionários com Observações Especiais:**")
-                        funcionarios_com_obs = resultado_final_df[
-                            resultado_final_df['OBS GERAL'].str.len() > 0
-                        ][['Matricula', 'OBS GERAL']]
-                        
-                        if not funcionarios_com_obs.empty:
-                            st.dataframe(funcionarios_com_obs)
-                        else:
-                            st.info("Nenhum funcionário com observações especiais.")
-                
+                    st.success("🎉 **Agente concluiu o processamento com sucesso!**")
                 else:
+                    processar_calculo_vr()
+                
+                if 'RESULTADO_FINAL' not in st.session_state.dfs:
                     st.error("❌ O agente finalizou, mas não gerou o resultado final. Verifique os logs acima.")
                     
             except Exception as e:
                 st.error(f"❌ **Erro durante a execução do agente:** {str(e)}")
                 st.write("**Detalhes do erro:**")
                 st.exception(e)
+
+    # Mostrar resultados (fora do botão, para continuarem visíveis ao paginar e filtrar)
+    if 'RESULTADO_FINAL' in st.session_state.dfs:
+        exibir_resultado_final(lambda: st.session_state.dfs['RESULTADO_FINAL'], st.session_state.resultado_referencia,
+                               chave=f"sessao_{st.session_state.resultado_id}")
                 
 else:
     st.info("📋 **Aguardando o carregamento dos ficheiros obrigatórios para habilitar o agente.**")
@@ -870,6 +1230,30 @@ else:
         for missing in missing_files:
             st.write(f"- {missing}")
 
+# Histórico das competências já calculadas
+competencias_historico = obter_historico().competencias()
+if not competencias_historico.empty:
+    with st.expander(f"📈 Histórico de Resultados ({len(competencias_historico)} competências)"):
+        exibir_historico(competencias_historico)
+
+# Cálculos em segundo plano (sobrevivem a recarregamentos da página)
+job_em_foco = st.query_params.get("job")
+jobs_recentes = {job['id']: job for job in obter_gerenciador_jobs().listar(st.session_state.dono_jobs)}
+if job_em_foco or jobs_recentes:
+    st.subheader("⏳ Cálculos em Segundo Plano")
+    opcoes_jobs = list(jobs_recentes)
+    if job_em_foco and job_em_foco not in jobs_recentes:
+        opcoes_jobs.insert(0, job_em_foco)
+    job_escolhido = st.selectbox(
+        "Acompanhar job",
+        opcoes_jobs,
+        index=opcoes_jobs.index(job_em_foco) if job_em_foco in opcoes_jobs else 0,
+        format_func=lambda job_id: f"{jobs_recentes[job_id]['descricao']} - {jobs_recentes[job_id]['status']} ({jobs_recentes[job_id]['criado_em']})" if job_id in jobs_recentes else job_id
+    )
+    if job_escolhido != job_em_foco:
+        st.query_params["job"] = job_escolhido
+    exibir_job(job_escolhido)
+
 # Footer
 st.markdown("---")
 
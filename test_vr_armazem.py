@@ -0,0 +1,111 @@
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from vr_armazem import GerenciadorArmazens, MB
+
+def tabela_exemplo(linhas=100):
+    return pd.DataFrame({
+        'MATRICULA': np.arange(linhas),
+        'Sindicato': ['SINDPD SP', None] * (linhas // 2),
+        'Admissão': pd.date_range('2020-01-01', periods=linhas, freq='D'),
+        'DIAS DE FÉRIAS': [np.nan, 5.0] * (linhas // 2),
+    })
+
+def test_tabela_volta_do_disco_igual(tmp_path):
+    armazem = GerenciadorArmazens(tmp_path).obter('sessao')
+    df = tabela_exemplo()
+    armazem['ATIVOS'] = df
+    armazem._descartar_da_memoria('ATIVOS')
+
+    lida = armazem['ATIVOS']
+    pd.testing.assert_frame_equal(lida, df, check_dtype=False)
+    assert lida['Sindicato'].isna().sum() == 50
+    assert armazem.linhas('ATIVOS') == 100
+    assert list(armazem) == ['ATIVOS']
+
+def test_coluna_com_tipos_misturados_volta_com_os_mesmos_valores(tmp_path):
+    armazem = GerenciadorArmazens(tmp_path).obter('sessao')
+    df = pd.DataFrame({'Cadastro': [1, 'A2', None], 'Valor': [1.0, 2.0, 3.0]})
+    armazem['EXTERIOR'] = df
+
+    armazem._descartar_da_memoria('EXTERIOR')
+    pd.testing.assert_frame_equal(armazem['EXTERIOR'], df)
+
+def test_datas_misturadas_com_texto_nao_mudam_ao_reler(tmp_path):
+    # A validação relê as datas com dayfirst: 12/05 não pode voltar como 05/12
+    armazem = GerenciadorArmazens(tmp_path).obter('sessao')
+    df = pd.DataFrame({
+        'MATRICULA': [1, 2, 3],
+        'Admissão': [datetime(2025, 5, 12), 'sem data', datetime(2024, 1, 3)],
+        'DATA DEMISSÃO': [None, datetime(2025, 5, 9), 'a confirmar'],
+    })
+    armazem['ATIVOS'] = df
+
+    armazem._descartar_da_memoria('ATIVOS')
+    lida = armazem['ATIVOS']
+    for col in ['Admissão', 'DATA DEMISSÃO']:
+        esperado = pd.to_datetime(df[col], dayfirst=True, errors='coerce', format='mixed')
+        relido = pd.to_datetime(lida[col], dayfirst=True, errors='coerce', format='mixed')
+        pd.testing.assert_series_equal(relido, esperado)
+    assert lida.loc[0, 'Admissão'] == datetime(2025, 5, 12)
+
+def test_orcamento_descarta_da_memoria_as_tabelas_menos_usadas(tmp_path):
+    df = tabela_exemplo(2000)
+    tamanho = df.memory_usage(deep=True, index=True).sum()
+    gerenciador = GerenciadorArmazens(tmp_path, orcamento_sessao_mb=2.5 * tamanho / MB)
+    armazem = gerenciador.obter('sessao')
+
+    armazem['A'] = df
+    armazem['B'] = df
+    armazem['A']  # A passa a ser a mais recente
+    armazem['C'] = df
+
+    assert set(armazem._memoria) == {'A', 'C'}
+    assert gerenciador.uso_memoria('sessao') <= gerenciador.orcamento_sessao
+    pd.testing.assert_frame_equal(armazem['B'], df, check_dtype=False)
+
+def test_sessoes_ociosas_sao_removidas(tmp_path):
+    gerenciador = GerenciadorArmazens(tmp_path, sessao_ociosa_min=1)
+    antiga = gerenciador.obter('antiga')
+    antiga['ATIVOS'] = tabela_exemplo()
+    antiga.ultimo_acesso -= 120
+
+    gerenciador.obter('nova')
+
+    assert 'antiga' not in gerenciador._armazens
+    assert not (tmp_path / 'antiga').exists()
+    assert gerenciador.uso_memoria('antiga') == 0
+
+def test_inicio_so_remove_pastas_paradas(tmp_path):
+    parada = tmp_path / 'parada'
+    ativa = tmp_path / 'ativa'
+    parada.mkdir()
+    ativa.mkdir()
+    duas_horas_atras = time.time() - 3 * 3600
+    os.utime(parada, (duas_horas_atras, duas_horas_atras))
+
+    GerenciadorArmazens(tmp_path, sessao_ociosa_min=120)
+
+    assert not parada.exists()
+    assert ativa.exists()
+
+def test_reruns_sem_ler_tabelas_mantem_a_sessao(tmp_path):
+    gerenciador = GerenciadorArmazens(tmp_path, sessao_ociosa_min=1)
+    armazem = gerenciador.obter('paginando')
+    armazem['RESULTADO_FINAL'] = tabela_exemplo()
+    armazem.ultimo_acesso -= 50
+    duas_horas_atras = time.time() - 2 * 3600
+    os.utime(armazem.diretorio, (duas_horas_atras, duas_horas_atras))
+
+    assert gerenciador.obter('paginando') is armazem  # rerun: só consulta 'in' e linhas()
+    armazem.ultimo_acesso -= 50
+    gerenciador.obter('outra')
+
+    assert 'RESULTADO_FINAL' in gerenciador.obter('paginando')
+    assert armazem.diretorio.stat().st_mtime > duas_horas_atras
+    GerenciadorArmazens(tmp_path, sessao_ociosa_min=1)  # outro processo do servidor
+    assert armazem.diretorio.exists()
@@ -0,0 +1,184 @@
+import warnings
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from vr_calculo import (
+    calcular_dias_a_pagar, calcular_matriz_dias, calcular_dias_particionado, valorar_e_observar_particionado,
+    anexar_valor_diario, gerar_observacoes, pontuar_anomalias, identificar_casos_especiais, LIMIAR_ANOMALIA
+)
+
+def periodo(ano, mes, feriados=()):
+    mes_inicio = pd.Timestamp(ano, mes, 1)
+    return mes_inicio, mes_inicio + pd.offsets.MonthEnd(0), list(feriados)
+
+def base_funcionarios():
+    return pd.DataFrame({
+        'MATRICULA': [101, 102, 103, 104, 105, 106, 107],
+        'Sindicato': ['SINDPD SP', 'SINDPD RJ', None, 'SITEPD PR', 'SINDPPD RS', 'SINDPD SP', 'SINDPD RJ'],
+        'Admissão': [pd.Timestamp(2020, 1, 1), pd.Timestamp(2025, 5, 12), pd.NaT, pd.Timestamp(2019, 3, 4),
+                     pd.Timestamp(2025, 6, 2), pd.Timestamp(2018, 8, 1), pd.Timestamp(2021, 2, 1)],
+        'DATA DEMISSÃO': [pd.NaT, pd.NaT, pd.Timestamp(2025, 5, 10), pd.Timestamp(2025, 5, 20), pd.NaT,
+                          pd.Timestamp(2025, 5, 9), pd.NaT],
+        'COMUNICADO DE DESLIGAMENTO': [np.nan, np.nan, 'OK', 'ok ', np.nan, 'PENDENTE', np.nan],
+        'DIAS DE FÉRIAS': [np.nan, 0, np.nan, 5, np.nan, np.nan, 10],
+    })
+
+def test_matriz_de_dias_igual_ao_calculo_por_linha():
+    df = base_funcionarios()
+    feriados = [date(2025, 5, 1)]
+    mes_inicio, mes_fim, feriados_periodo = periodo(2025, 5, feriados)
+
+    esperado = calcular_dias_a_pagar(df, mes_inicio=mes_inicio, mes_fim=mes_fim, mes_referencia=5,
+                                     feriados_periodo=feriados_periodo)
+    matriz = calcular_matriz_dias(df, {(2025, 5): (mes_inicio, mes_fim, feriados_periodo)}, competencia_ferias=(2025, 5))
+
+    assert matriz['05/2025'].tolist() == esperado.tolist()
+
+def test_matriz_de_dias_so_desconta_ferias_na_competencia_carregada():
+    df = base_funcionarios()
+    periodos = {(2025, 4): periodo(2025, 4), (2025, 5): periodo(2025, 5)}
+    com_ferias = calcular_matriz_dias(df, periodos, competencia_ferias=(2025, 5))
+    sem_ferias = calcular_matriz_dias(df.assign(**{'DIAS DE FÉRIAS': 0}), periodos, competencia_ferias=(2025, 5))
+
+    assert com_ferias['04/2025'].tolist() == sem_ferias['04/2025'].tolist()
+    assert com_ferias.loc[6, '05/2025'] < sem_ferias.loc[6, '05/2025']
+
+def test_matriz_de_dias_considera_o_ano_do_desligamento():
+    # Desligado em 10/12/2025 com comunicado OK: dezembro de 2024 é pago normalmente
+    df = pd.DataFrame({
+        'MATRICULA': [1],
+        'Admissão': [pd.Timestamp(2020, 1, 1)],
+        'DATA DEMISSÃO': [pd.Timestamp(2025, 12, 10)],
+        'COMUNICADO DE DESLIGAMENTO': ['OK'],
+    })
+    matriz = calcular_matriz_dias(df, {(2024, 12): periodo(2024, 12), (2025, 12): periodo(2025, 12)})
+
+    assert matriz.loc[0, '12/2024'] == np.busday_count('2024-12-01', '2025-01-01')
+    assert matriz.loc[0, '12/2025'] == 0
+
+def valores_por_estado():
+    return pd.DataFrame({'Estado': ['São Paulo', 'Rio de Janeiro', 'Paraná'], 'VALOR DIÁRIO VR': [37.5, 35.0, 35.0]})
+
+def test_execucao_particionada_igual_a_sequencial():
+    df = pd.concat([base_funcionarios()] * 30, ignore_index=True)
+    df['MATRICULA'] = np.arange(len(df))
+    df['Observacao_IA'] = ''
+    mes_inicio, mes_fim, feriados_periodo = periodo(2025, 5, [date(2025, 5, 1)])
+    parametros = dict(mes_inicio=mes_inicio, mes_fim=mes_fim, mes_referencia=5, feriados_periodo=feriados_periodo)
+
+    dias_sequencial = calcular_dias_particionado(df, 1, **parametros)
+    sequencial = valorar_e_observar_particionado(df.assign(Dias_A_Pagar=dias_sequencial), valores_por_estado(), 1)
+    for chave in ['MATRICULA', 'Sindicato']:
+        dias_paralelo = calcular_dias_particionado(df, 3, chave=chave, **parametros)
+        pd.testing.assert_series_equal(dias_paralelo, dias_sequencial)
+        paralelo = valorar_e_observar_particionado(df.assign(Dias_A_Pagar=dias_paralelo), valores_por_estado(), 3, chave=chave)
+        pd.testing.assert_frame_equal(paralelo, sequencial)
+
+def gerar_observacao_por_linha(row):
+    """Versão original (linha a linha) da 'OBS GERAL', usada como referência."""
+    obs_padrao = []
+    obs_ia = row.get('Observacao_IA', '')
+    if row['sindicato_ausente']: obs_padrao.append('Sindicato não informado; atribuído SP por padrão')
+    if row['VALOR DIÁRIO VR'] == 0: obs_padrao.append('Valor diário não encontrado para o estado')
+    if row['Dias_A_Pagar'] == 0 and pd.notna(row.get('DATA DEMISSÃO')):
+        if str(row.get('COMUNICADO DE DESLIGAMENTO', '')).strip().upper() == 'OK':
+            obs_padrao.append('Desligado até dia 15 com comunicado OK')
+    todas_obs = obs_padrao + ([obs_ia] if obs_ia and obs_ia.strip() else [])
+    return '; '.join(todas_obs)
+
+def test_observacoes_vetorizadas_iguais_as_por_linha():
+    df = base_funcionarios()
+    df['Dias_A_Pagar'] = [22, 0, 0, 0, 15, 0, 12]
+    df['Observacao_IA'] = ['', 'Revisar admissão', '  ', '', 'Conferir sindicato', '', '']
+    df = anexar_valor_diario(df, valores_por_estado())
+
+    esperado = df.apply(gerar_observacao_por_linha, axis=1)
+    resultado = gerar_observacoes(df.copy())['OBS GERAL']
+
+    assert resultado.tolist() == esperado.tolist()
+    assert 'Sindicato não informado; atribuído SP por padrão' in resultado.iloc[2]
+    assert resultado.iloc[4].endswith('Conferir sindicato')
+
+def test_observacoes_de_base_vazia():
+    df = anexar_valor_diario(base_funcionarios().iloc[:0].assign(Dias_A_Pagar=0, Observacao_IA=''), valores_por_estado())
+    assert gerar_observacoes(df)['OBS GERAL'].empty
+
+def test_anomalias_em_relacao_ao_mes_anterior():
+    atual = pd.DataFrame({
+        'MATRICULA': [1, 2, 3, 4, 5, 6],
+        'Sindicato': ['SINDPD SP', 'SINDPD SP', 'SINDPD RJ', 'SINDPD SP', 'SINDPD SP', 'SINDPD SP'],
+        'Dias_A_Pagar': [22, 21, 22, 2, 22, 22],
+    }, index=[10, 11, 12, 13, 14, 15])
+    anterior = pd.DataFrame({
+        'matricula': ['1', '2', '3', '4', '5'],
+        'sindicato': ['SINDPD SP', 'SINDPD SP', 'SINDPD SP', 'SINDPD SP', 'SINDPD SP'],
+        'dias': [21, 20, 21, 21, 21],
+        'total': [21 * 37.5, 20 * 37.5, 21 * 37.5, 21 * 37.5, 21 * 37.5],
+    })
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        anomalias = pontuar_anomalias(atual, anterior, valores_por_estado())
+
+    assert anomalias.index.tolist() == atual.index.tolist()
+    assert anomalias['Tem_Historico'].tolist() == [True, True, True, True, True, False]
+    atipicos = anomalias.index[anomalias['Pontuacao_Anomalia'] >= LIMIAR_ANOMALIA].tolist()
+    assert atipicos == [12, 13]
+    assert 'Troca de sindicato' in anomalias.loc[12, 'Motivo_Anomalia']
+    assert 'Dias atípicos em relação ao mês anterior (21 → 2)' in anomalias.loc[13, 'Motivo_Anomalia']
+    assert anomalias.loc[15, 'Pontuacao_Anomalia'] == 0
+    assert anomalias.loc[[10, 11, 14, 15], 'Motivo_Anomalia'].eq('').all()
+
+def test_limiar_de_anomalia_configuravel():
+    atual = pd.DataFrame({'MATRICULA': [1, 2, 3, 4], 'Sindicato': 'SINDPD SP', 'Dias_A_Pagar': [22, 22, 22, 19]})
+    anterior = pd.DataFrame({'matricula': [1, 2, 3, 4], 'sindicato': 'SINDPD SP', 'dias': [21] * 4, 'total': [21 * 37.5] * 4})
+
+    padrao = pontuar_anomalias(atual, anterior, valores_por_estado())
+    sensivel = pontuar_anomalias(atual, anterior, valores_por_estado(), limiar=2.0)
+
+    assert 2.0 <= padrao.loc[3, 'Pontuacao_Anomalia'] < LIMIAR_ANOMALIA
+    assert padrao.loc[3, 'Motivo_Anomalia'] == ''
+    assert sensivel.loc[3, 'Motivo_Anomalia'].startswith('Dias atípicos')
+
+def casos_do_mes():
+    atual = pd.DataFrame({
+        'MATRICULA': [1, 2, 3, 4, 5, 6],
+        'Sindicato': 'SINDPD SP',
+        'Admissão': [pd.Timestamp(2020, 1, 1), pd.Timestamp(2025, 5, 12)] + [pd.Timestamp(2020, 1, 1)] * 4,
+        'DATA DEMISSÃO': pd.NaT,
+        'COMUNICADO DE DESLIGAMENTO': [np.nan] * 5 + ['PENDENTE'],
+        'Dias_A_Pagar': [22, 15, 0, 2, 22, 22],
+    })
+    # Sem histórico para a matrícula 2 (admitida no mês); a 3 já vinha com pagamento zerado
+    anterior = pd.DataFrame({
+        'matricula': [1, 3, 4, 5, 6],
+        'sindicato': 'SINDPD SP',
+        'dias': [21, 0, 21, 21, 21],
+        'total': [21 * 37.5, 0.0, 21 * 37.5, 21 * 37.5, 21 * 37.5],
+    })
+    return atual, pontuar_anomalias(atual, anterior, valores_por_estado())
+
+def test_casos_especiais_sem_historico_seguem_as_regras():
+    atual, _ = casos_do_mes()
+    casos = identificar_casos_especiais(atual.copy(), 5, 2025)['Motivo_Analise_IA']
+    assert casos.tolist() == ['', 'Admissão recente; ', 'Pagamento zerado; ', '', '', '']
+
+def test_casos_especiais_so_os_atipicos_por_padrao():
+    atual, anomalias = casos_do_mes()
+    casos = identificar_casos_especiais(atual.copy(), 5, 2025, anomalias)['Motivo_Analise_IA']
+
+    # A 3 repete o pagamento zerado do mês anterior e sai; a 4 não cai em regra nenhuma,
+    # mas os dias caíram de 21 para 2
+    assert casos.index[casos != ''].tolist() == [1, 3]
+    assert casos.iloc[1] == 'Admissão recente; '
+    assert casos.iloc[3].startswith('Dias atípicos em relação ao mês anterior (21 → 2)')
+
+def test_casos_especiais_com_todas_as_regras():
+    atual, anomalias = casos_do_mes()
+    casos = identificar_casos_especiais(atual.copy(), 5, 2025, anomalias, somente_atipicos=False)['Motivo_Analise_IA']
+    assert casos.index[casos != ''].tolist() == [1, 2, 3]
+
+    tolerante = identificar_casos_especiais(atual.copy(), 5, 2025, anomalias, limiar=50)['Motivo_Analise_IA']
+    assert tolerante.index[tolerante != ''].tolist() == [1]
@@ -0,0 +1,66 @@
+import pandas as pd
+
+from vr_explorador import ExploradorResultado, extrair_estado
+
+def extrair_estado_por_linha(sindicato):
+    """Versão original (linha a linha) da análise por estado, usada como referência."""
+    if pd.isna(sindicato):
+        return 'Não informado'
+    sindicato_upper = str(sindicato).upper()
+    if 'SP' in sindicato_upper: return 'São Paulo'
+    elif 'RJ' in sindicato_upper: return 'Rio de Janeiro'
+    elif 'RS' in sindicato_upper: return 'Rio Grande do Sul'
+    elif 'PR' in sindicato_upper: return 'Paraná'
+    else: return 'Outros'
+
+def resultado_exemplo():
+    return pd.DataFrame({
+        'Matricula': [30, 10, 20, 40, 50],
+        'Admissão': ['01/12/2024', '02/01/2023', None, '15/06/2024', '31/01/2025'],
+        'Sindicato do Colaborador': ['SINDPD SP', 'SINDPD RJ', None, 'SITEPD PR', 'SINDICATO BA'],
+        'Competência': '05/2025',
+        'Dias': [22, 20, 0, 18, 21],
+        'VALOR DIÁRIO VR': [37.5, 35.0, 0.0, 35.0, 37.5],
+        'TOTAL': [825.0, 700.0, 0.0, 630.0, 787.5],
+        'Custo empresa': [660.0, 560.0, 0.0, 504.0, 630.0],
+        'Desconto profissional': [165.0, 140.0, 0.0, 126.0, 157.5],
+        'OBS GERAL': ['', '', 'Valor diário não encontrado para o estado', 'Revisar férias', ''],
+    })
+
+def test_extrair_estado_igual_ao_por_linha():
+    sindicatos = pd.Series(['SINDPD SP', 'sindpd rj', None, 'SITEPD PR', 'SINDPPD RS', 'OUTRO', 'SP e RJ'])
+    assert extrair_estado(sindicatos).tolist() == sindicatos.map(extrair_estado_por_linha).tolist()
+
+def test_metricas_e_distribuicao_por_estado():
+    explorador = ExploradorResultado(resultado_exemplo())
+    assert explorador.metricas['funcionarios'] == 5
+    assert explorador.metricas['total'] == 2942.5
+    assert explorador.metricas['com_observacao'] == 2
+    assert explorador.por_estado.loc['Outros', 'Funcionários'] == 1
+    assert explorador.por_estado.loc['São Paulo', 'Valor Total'] == 825.0
+
+def test_paginacao_e_filtros():
+    explorador = ExploradorResultado(resultado_exemplo())
+
+    pagina, total = explorador.consultar(ordenar_por='Matricula', pagina=2, tamanho_pagina=2)
+    assert total == 5
+    assert pagina['Matricula'].tolist() == [30, 40]
+    assert list(pagina.columns) == list(resultado_exemplo().columns)
+
+    assert explorador.contar(somente_com_obs=True) == 2
+    assert explorador.contar(estados=['São Paulo', 'Paraná']) == 2
+    assert explorador.consultar(busca='revisar')[0]['Matricula'].tolist() == [40]
+    assert explorador.consultar(busca='20', ordenar_por='Matricula')[0]['Matricula'].tolist() == [20]
+
+def test_ordena_admissao_pela_data():
+    explorador = ExploradorResultado(resultado_exemplo())
+    crescente, _ = explorador.consultar(ordenar_por='Admissão', colunas=['Admissão'])
+    decrescente, _ = explorador.consultar(ordenar_por='Admissão', decrescente=True, colunas=['Admissão'])
+
+    assert crescente['Admissão'].tolist()[:4] == ['02/01/2023', '15/06/2024', '01/12/2024', '31/01/2025']
+    assert decrescente['Admissão'].tolist()[:4] == ['31/01/2025', '01/12/2024', '15/06/2024', '02/01/2023']
+    assert pd.isna(crescente['Admissão'].iloc[-1])
+
+def test_planilha_sem_colunas_auxiliares():
+    df = resultado_exemplo()
+    pd.testing.assert_frame_equal(ExploradorResultado(df).para_pandas(), df, check_dtype=False)
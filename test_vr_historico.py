@@ -0,0 +1,107 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from vr_historico import HistoricoResultados, ORIGEM_LOTE, codigo_competencia, competencia_anterior, rotulo_competencia
+
+def resultado(matriculas, dias, sindicatos, valor_diario=37.5):
+    total = np.asarray(dias, dtype=float) * valor_diario
+    return pd.DataFrame({
+        'Matricula': matriculas,
+        'Admissão': '01/01/2020',
+        'Sindicato do Colaborador': sindicatos,
+        'Competência': '',
+        'Dias': dias,
+        'VALOR DIÁRIO VR': valor_diario,
+        'TOTAL': total,
+        'Custo empresa': total * 0.8,
+        'Desconto profissional': total * 0.2,
+        'OBS GERAL': '',
+    })
+
+def test_competencias():
+    assert codigo_competencia(2025, 5) == 202505
+    assert rotulo_competencia(202505) == '05/2025'
+    assert competencia_anterior(202501) == 202412
+
+def test_gravar_e_ler_competencia(tmp_path):
+    historico = HistoricoResultados(tmp_path)
+    historico.gravar(resultado([1, 2, 3], [22, 20, 0], ['SINDPD SP', 'SINDPD RJ', None]), 2025, 4)
+
+    lido = historico.resultado_competencia(202504).sort_values('matricula').reset_index(drop=True)
+    assert lido['matricula'].tolist() == [1, 2, 3]
+    assert lido['dias'].tolist() == [22, 20, 0]
+    assert lido['sindicato'].tolist()[:2] == ['SINDPD SP', 'SINDPD RJ']
+    assert pd.isna(lido['sindicato'].iloc[2])
+    assert historico.resultado_competencia(202505).empty
+
+def test_gravar_de_novo_substitui_a_competencia(tmp_path):
+    historico = HistoricoResultados(tmp_path)
+    historico.gravar(resultado([1, 2, 3], [22, 20, 0], ['SINDPD SP'] * 3), 2025, 4)
+    historico.gravar(resultado([1, 2], [10, 10], ['SINDPD SP'] * 2), 2025, 4)
+
+    assert len(historico.resultado_competencia(202504)) == 2
+    resumo = historico.resumo_mensal()
+    assert resumo['funcionarios'].tolist() == [2]
+    assert resumo['total'].tolist() == [750.0]
+
+def test_lote_nao_substitui_competencia_de_calculo_normal(tmp_path):
+    historico = HistoricoResultados(tmp_path)
+    historico.gravar(resultado([1, 2], [22, 12], ['SINDPD SP'] * 2), 2025, 4, 'calculo')
+
+    assert historico.gravar(resultado([1, 2], [22, 22], ['SINDPD SP'] * 2), 2025, 4, ORIGEM_LOTE) == 0
+    assert historico.gravar(resultado([1, 2], [21, 21], ['SINDPD SP'] * 2), 2025, 3, ORIGEM_LOTE) == 2
+    assert historico.resultado_competencia(202504)['dias'].tolist() == [22, 12]
+    assert historico.competencias().set_index('competencia')['origem'].to_dict() == {202504: 'calculo', 202503: ORIGEM_LOTE}
+
+    # Lote sobre lote substitui; um cálculo normal substitui o lote
+    assert historico.gravar(resultado([1], [20], ['SINDPD SP']), 2025, 3, ORIGEM_LOTE) == 1
+    assert historico.resultado_competencia(202503, incluir_lote=False).empty
+    historico.gravar(resultado([1, 2], [19, 19], ['SINDPD SP'] * 2), 2025, 3, 'calculo')
+    assert historico.resultado_competencia(202503, incluir_lote=False)['dias'].tolist() == [19, 19]
+    assert historico.resumo_mensal()['funcionarios'].tolist() == [2, 2]
+
+def test_totais_historico_e_variacao(tmp_path):
+    historico = HistoricoResultados(tmp_path)
+    historico.gravar(resultado([1, 2, 3], [22, 20, 21], ['SINDPD SP', 'SINDPD RJ', 'SINDPD SP']), 2025, 4)
+    historico.gravar(resultado([1, 2, 4], [22, 10, 21], ['SINDPD SP', 'SINDPD SP', 'SINDPD RJ']), 2025, 5)
+
+    totais = historico.totais_por('estado', 202505, 202505).set_index('estado')
+    assert totais.loc['São Paulo', 'funcionarios'] == 2
+    assert totais.loc['Rio de Janeiro', 'total'] == 21 * 37.5
+
+    func = historico.historico_funcionario('2')
+    assert func['competencia'].tolist() == [202504, 202505]
+    assert func['dias'].tolist() == [20, 10]
+
+    resumo = historico.resumo_mensal()
+    assert resumo['delta_total'].iloc[1] == (22 + 10 + 21 - 22 - 20 - 21) * 37.5
+
+    detalhes, contagem = historico.variacao_mensal(202505)
+    variacoes = dict(zip(detalhes['matricula'], detalhes['variacao']))
+    assert variacoes == {2: 'Trocou de sindicato', 3: 'Saiu', 4: 'Entrou'}
+    assert contagem.set_index('variacao').loc['Igual', 'funcionarios'] == 1
+    assert detalhes.set_index('matricula').loc[2, 'delta_dias'] == -10
+
+def test_consultas_indexadas_em_base_grande(tmp_path):
+    # 12 competências de 50 mil funcionários (600 mil linhas): as consultas de resumo
+    # usam a tabela consolidada e a de funcionário usa o índice por matrícula
+    historico = HistoricoResultados(tmp_path)
+    matriculas = np.arange(50_000)
+    sindicatos = np.where(matriculas % 3 == 0, 'SINDPD RJ', 'SINDPD SP')
+    for mes in range(1, 13):
+        historico.gravar(resultado(matriculas, (matriculas + mes) % 23, sindicatos), 2024, mes)
+
+    inicio = time.perf_counter()
+    func = historico.historico_funcionario(12_345)
+    totais = historico.totais_por('sindicato')
+    resumo = historico.resumo_mensal()
+    detalhes, _ = historico.variacao_mensal(202412, limite=100)
+    duracao = time.perf_counter() - inicio
+
+    assert len(func) == 12
+    assert len(totais) == 24
+    assert resumo['funcionarios'].tolist() == [50_000] * 12
+    assert len(detalhes) == 100
+    assert duracao < 2.0
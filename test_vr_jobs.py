@@ -0,0 +1,96 @@
+import threading
+import time
+from contextlib import closing
+
+import pandas as pd
+import pytest
+
+from vr_jobs import GerenciadorJobs, FilaCheiaError, STATUS_ATIVOS, STATUS_CONCLUIDO, STATUS_ERRO
+
+def esperar_fim(gerenciador, job_id, dono, tempo_maximo=10):
+    limite = time.monotonic() + tempo_maximo
+    while time.monotonic() < limite:
+        job = gerenciador.obter(job_id, dono)
+        if job['status'] not in STATUS_ATIVOS:
+            return job
+        time.sleep(0.02)
+    raise TimeoutError(job_id)
+
+def calculo_ok(saida, linhas):
+    saida.write("calculando")
+    saida.progress(0.5, text="metade")
+    return pd.DataFrame({'Matricula': range(linhas), 'TOTAL': [10.0] * linhas}), "pronto"
+
+def calculo_sem_resultado(saida):
+    return None, "Erro: Arquivo VALORES não encontrado"
+
+def test_job_concluido_grava_log_e_resultado(tmp_path):
+    gerenciador = GerenciadorJobs(tmp_path)
+    job_id = gerenciador.submeter("Cálculo", calculo_ok, 'dono-a', metadados={'reference_date': '2025-05-01'}, linhas=3)
+    job = esperar_fim(gerenciador, job_id, 'dono-a')
+
+    assert job['status'] == STATUS_CONCLUIDO
+    assert job['mensagem'] == "pronto"
+    assert job['metadados'] == {'reference_date': '2025-05-01'}
+    assert gerenciador.eventos(job_id) == [('write', 'calculando')]
+    pd.testing.assert_frame_equal(gerenciador.carregar_resultado(job_id), calculo_ok(saida=_Nulo(), linhas=3)[0])
+
+def test_job_sem_resultado_termina_com_erro(tmp_path):
+    gerenciador = GerenciadorJobs(tmp_path)
+    job_id = gerenciador.submeter("Cálculo", calculo_sem_resultado, 'dono-a')
+    job = esperar_fim(gerenciador, job_id, 'dono-a')
+    assert job['status'] == STATUS_ERRO
+    assert gerenciador.carregar_resultado(job_id) is None
+
+def test_resultado_apagado_volta_como_none(tmp_path):
+    gerenciador = GerenciadorJobs(tmp_path)
+    job_id = gerenciador.submeter("Cálculo", calculo_ok, 'dono-a', linhas=2)
+    assert esperar_fim(gerenciador, job_id, 'dono-a')['status'] == STATUS_CONCLUIDO
+
+    gerenciador._caminho_resultado(job_id).unlink()
+    assert gerenciador.carregar_resultado(job_id) is None
+
+def test_jobs_so_aparecem_para_o_dono(tmp_path):
+    gerenciador = GerenciadorJobs(tmp_path)
+    job_a = gerenciador.submeter("A", calculo_ok, 'dono-a', linhas=1)
+    job_b = gerenciador.submeter("B", calculo_ok, 'dono-b', linhas=1)
+    esperar_fim(gerenciador, job_a, 'dono-a')
+    esperar_fim(gerenciador, job_b, 'dono-b')
+
+    assert [job['id'] for job in gerenciador.listar('dono-a')] == [job_a]
+    assert gerenciador.obter(job_b, 'dono-a') is None
+    assert gerenciador.obter(job_a, 'dono-a') is not None
+
+def test_fila_cheia_recusa_novos_jobs(tmp_path):
+    liberar = threading.Event()
+    def calculo_bloqueado(saida):
+        liberar.wait(10)
+        return None, "fim"
+
+    gerenciador = GerenciadorJobs(tmp_path, max_simultaneos=1, max_na_fila=1)
+    try:
+        gerenciador.submeter("1", calculo_bloqueado, 'dono-a')
+        gerenciador.submeter("2", calculo_bloqueado, 'dono-a')
+        with pytest.raises(FilaCheiaError):
+            gerenciador.submeter("3", calculo_bloqueado, 'dono-b')
+        assert gerenciador.contar_ativos() == 2
+    finally:
+        liberar.set()
+
+def test_limpeza_apaga_jobs_antigos_e_resultados(tmp_path):
+    gerenciador = GerenciadorJobs(tmp_path, retencao_dias=1)
+    job_id = gerenciador.submeter("Antigo", calculo_ok, 'dono-a', linhas=2)
+    esperar_fim(gerenciador, job_id, 'dono-a')
+    assert gerenciador._caminho_resultado(job_id).exists()
+
+    with closing(gerenciador._conectar()) as conexao:
+        conexao.execute("UPDATE jobs SET finalizado_em = '2000-01-01T00:00:00' WHERE id = ?", (job_id,))
+
+    assert gerenciador.limpar_antigos() == 1
+    assert gerenciador.obter(job_id, 'dono-a') is None
+    assert gerenciador.eventos(job_id) == []
+    assert not gerenciador._caminho_resultado(job_id).exists()
+
+class _Nulo:
+    def write(self, texto): pass
+    def progress(self, valor, text=None): return self
@@ -0,0 +1,217 @@
+import os
+import pickle
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+# =====================================================================================
+# ARMAZÉM DE TABELAS DAS SESSÕES COM ORÇAMENTO DE MEMÓRIA
+# Cada tabela é gravada em disco (Arrow IPC) assim que entra no armazém; a cópia em
+# memória é só um cache, descartado por ordem de uso (LRU) quando a sessão ou o
+# servidor passam do orçamento, e relida do disco quando for pedida de novo.
+# =====================================================================================
+
+MB = 1024 * 1024
+
+def _tamanho_em_memoria(df):
+    return int(df.memory_usage(deep=True, index=True).sum())
+
+def _gravar_tabela(df, destino):
+    """
+    Grava a tabela em Arrow IPC. Tabelas que o Arrow não representa sem mudar os dados,
+    como colunas com tipos misturados (datas e textos, números e textos), vão para pickle:
+    converter essas colunas para texto mudaria o valor lido de volta (uma data vira
+    '2025-05-12 00:00:00', que a validação relê com dayfirst como 05/12/2025).
+    """
+    try:
+        tabela = pa.Table.from_pandas(df, preserve_index=True)
+        caminho = destino.with_suffix('.arrow')
+        with pa.OSFile(str(caminho), 'wb') as arquivo, pa.ipc.new_file(arquivo, tabela.schema) as escritor:
+            escritor.write_table(tabela)
+    except (pa.ArrowException, TypeError, ValueError):
+        destino.with_suffix('.arrow').unlink(missing_ok=True)
+        caminho = destino.with_suffix('.pkl')
+        with open(caminho, 'wb') as arquivo:
+            pickle.dump(df, arquivo, protocol=pickle.HIGHEST_PROTOCOL)
+    return caminho
+
+def _ler_tabela(caminho):
+    """
+    Lê uma tabela gravada por `_gravar_tabela`. O memory map evita ler o arquivo para um
+    buffer intermediário, mas a conversão para pandas copia os dados: a tabela lida ocupa
+    memória como qualquer DataFrame, e é essa cópia que entra no orçamento.
+    """
+    if caminho.suffix == '.pkl':
+        with open(caminho, 'rb') as arquivo:
+            return pickle.load(arquivo)
+    with pa.memory_map(str(caminho), 'r') as origem:
+        df = pa.ipc.open_file(origem).read_all().to_pandas()
+    # O Arrow devolve nulos de colunas de texto como None; o restante do app espera NaN,
+    # como vem do read_excel
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(df[col].notna(), np.nan)
+    return df
+
+class ArmazemTabelas(MutableMapping):
+    """
+    Dicionário {nome: DataFrame} de uma sessão. As tabelas ficam em disco e só as usadas
+    mais recentemente são mantidas em memória, dentro do orçamento do gerenciador.
+    """
+    def __init__(self, gerenciador, sessao_id, diretorio):
+        self._gerenciador = gerenciador
+        self.sessao_id = sessao_id
+        self.diretorio = Path(diretorio)
+        self.diretorio.mkdir(parents=True, exist_ok=True)
+        self._arquivos = {}
+        self._linhas = {}
+        self._memoria = {}
+        self.ultimo_acesso = time.monotonic()
+
+    def __setitem__(self, chave, df):
+        self.ultimo_acesso = time.monotonic()
+        if chave in self._arquivos:
+            del self[chave]
+        self._arquivos[chave] = _gravar_tabela(df, self.diretorio / str(chave))
+        self._linhas[chave] = len(df)
+        self._memoria[chave] = df
+        self._gerenciador._registrar_uso(self, chave, _tamanho_em_memoria(df))
+
+    def __getitem__(self, chave):
+        self.ultimo_acesso = time.monotonic()
+        if chave not in self._arquivos:
+            raise KeyError(chave)
+        df = self._memoria.get(chave)
+        if df is None:
+            df = _ler_tabela(self._arquivos[chave])
+            self._memoria[chave] = df
+            self._gerenciador._registrar_uso(self, chave, _tamanho_em_memoria(df))
+        else:
+            self._gerenciador._registrar_uso(self, chave)
+        return df
+
+    def __delitem__(self, chave):
+        caminho = self._arquivos.pop(chave)
+        self._linhas.pop(chave, None)
+        self._memoria.pop(chave, None)
+        self._gerenciador._esquecer(self, chave)
+        caminho.unlink(missing_ok=True)
+
+    def __iter__(self):
+        return iter(list(self._arquivos))
+
+    def __len__(self):
+        return len(self._arquivos)
+
+    def __contains__(self, chave):
+        return chave in self._arquivos
+
+    def clear(self):
+        for chave in list(self._arquivos):
+            del self[chave]
+
+    def linhas(self, chave):
+        """Número de registros da tabela, sem precisar carregá-la do disco."""
+        return self._linhas[chave]
+
+    def tocar(self):
+        """
+        Marca a sessão como ativa. Também atualiza o mtime da pasta, que é o que outro
+        processo do servidor usa em `_remover_sobras` para saber se a sessão está parada.
+        """
+        self.ultimo_acesso = time.monotonic()
+        try:
+            os.utime(self.diretorio)
+        except OSError:
+            pass
+
+    def _descartar_da_memoria(self, chave):
+        self._memoria.pop(chave, None)
+
+class GerenciadorArmazens:
+    """
+    Controla os armazéns de todas as sessões do servidor: orçamento de memória por
+    sessão e global (com descarte LRU para o disco) e limpeza de sessões ociosas.
+    """
+    def __init__(self, diretorio, orcamento_sessao_mb=256, orcamento_global_mb=1024, sessao_ociosa_min=120):
+        self.diretorio = Path(diretorio)
+        self.orcamento_sessao = orcamento_sessao_mb * MB
+        self.orcamento_global = orcamento_global_mb * MB
+        self.sessao_ociosa_seg = sessao_ociosa_min * 60
+        self._lock = threading.RLock()
+        self._armazens = {}
+        self._uso = OrderedDict()  # (sessao_id, chave) -> bytes, do menos para o mais recente
+        self.diretorio.mkdir(parents=True, exist_ok=True)
+        self._remover_sobras()
+
+    def _remover_sobras(self):
+        """
+        Remove as pastas de sessões paradas há mais tempo que o limite de ociosidade,
+        sobras de execuções anteriores. Pastas recentes podem ser de outro processo do
+        servidor usando o mesmo diretório e são mantidas: cada rerun de uma sessão ativa
+        atualiza o mtime da pasta (`ArmazemTabelas.tocar`).
+        """
+        limite = time.time() - self.sessao_ociosa_seg
+        for pasta in self.diretorio.iterdir():
+            if pasta.is_dir() and pasta.stat().st_mtime < limite:
+                shutil.rmtree(pasta, ignore_errors=True)
+
+    def obter(self, sessao_id):
+        """
+        Retorna o armazém da sessão, criando-o se preciso, e limpa as sessões ociosas.
+        Cada chamada (um rerun da sessão) conta como acesso, mesmo sem ler nenhuma tabela.
+        """
+        with self._lock:
+            self.limpar_ociosas()
+            if sessao_id not in self._armazens:
+                self._armazens[sessao_id] = ArmazemTabelas(self, sessao_id, self.diretorio / sessao_id)
+            armazem = self._armazens[sessao_id]
+            armazem.tocar()
+            return armazem
+
+    def uso_memoria(self, sessao_id=None):
+        """Bytes em memória de uma sessão, ou de todo o servidor se `sessao_id` for None."""
+        with self._lock:
+            return sum(tamanho for (sessao, _), tamanho in self._uso.items() if sessao_id in (None, sessao))
+
+    def limpar_ociosas(self):
+        with self._lock:
+            agora = time.monotonic()
+            for sessao_id, armazem in list(self._armazens.items()):
+                if agora - armazem.ultimo_acesso > self.sessao_ociosa_seg:
+                    for chave in list(armazem._arquivos):
+                        self._esquecer(armazem, chave)
+                    del self._armazens[sessao_id]
+                    shutil.rmtree(armazem.diretorio, ignore_errors=True)
+
+    def _registrar_uso(self, armazem, chave, tamanho=None):
+        with self._lock:
+            item = (armazem.sessao_id, chave)
+            if tamanho is None:
+                self._uso.move_to_end(item)
+            else:
+                self._uso.pop(item, None)
+                self._uso[item] = tamanho
+            self._aplicar_orcamento(armazem.sessao_id, item)
+
+    def _esquecer(self, armazem, chave):
+        with self._lock:
+            self._uso.pop((armazem.sessao_id, chave), None)
+
+    def _aplicar_orcamento(self, sessao_id, item_atual):
+        """Descarta da memória as tabelas usadas há mais tempo até caber nos orçamentos."""
+        for item in list(self._uso):
+            if self.uso_memoria(sessao_id) <= self.orcamento_sessao and self.uso_memoria() <= self.orcamento_global:
+                return
+            sessao, chave = item
+            if item == item_atual:
+                continue
+            if self.uso_memoria() <= self.orcamento_global and sessao != sessao_id:
+                continue
+            self._uso.pop(item)
+            self._armazens[sessao]._descartar_da_memoria(chave)
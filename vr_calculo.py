@@ -0,0 +1,366 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import pandas as pd
+import numpy as np
+
+# =====================================================================================
+# ESTÁGIOS PUROS DO CÁLCULO DE VR
+# Estas funções não dependem do Streamlit, para que possam rodar tanto no processo
+# principal quanto nos processos do executor paralelo com o mesmo resultado.
+# =====================================================================================
+
+def calcular_dias_trabalhados(funcionario, mes_inicio, mes_fim, mes_referencia, feriados_periodo,
+                              dias_uteis_por_sindicato=None, usar_dias_uteis_base=False):
+    """Calcula os dias trabalhados com a NOVA LÓGICA DE FÉRIAS."""
+
+    # Se a base de dias úteis for usada, a lógica de férias é um simples desconto
+    if usar_dias_uteis_base and 'Sindicato' in funcionario and pd.notna(funcionario['Sindicato']):
+        sindicato_func = str(funcionario['Sindicato']).strip()
+        for sind_base, dias_base in dias_uteis_por_sindicato.items():
+            if sind_base.upper() in sindicato_func.upper():
+                # Lógica simples de desconto, pois a base já define o total
+                dias_ferias = funcionario.get('DIAS DE FÉRIAS', 0)
+                return max(0, dias_base - dias_ferias)
+
+    # --- CÁLCULO DINÂMICO COM NOVA LÓGICA DE FÉRIAS ---
+    data_admissao = pd.to_datetime(funcionario.get('Admissão', pd.NaT), errors='coerce')
+    data_demissao = pd.to_datetime(funcionario.get('DATA DEMISSÃO', pd.NaT), errors='coerce')
+    comunicado_ok = str(funcionario.get('COMUNICADO DE DESLIGAMENTO', '')).strip().upper() == 'OK'
+    dias_ferias = funcionario.get('DIAS DE FÉRIAS', 0)
+    if pd.isna(dias_ferias): dias_ferias = 0
+
+    # Período base do mês
+    inicio_calculo_base = mes_inicio
+    fim_calculo = mes_fim
+
+    # <-- NOVA LÓGICA DE FÉRIAS: Desconta dias corridos do início do mês
+    if dias_ferias > 0:
+        # O trabalho só começa após o término das férias
+        # Adiciona (dias-1) ao dia 1 para achar o último dia de férias
+        # e +1 para achar o primeiro dia de trabalho
+        inicio_apos_ferias = mes_inicio + pd.Timedelta(days=dias_ferias)
+        inicio_calculo_base = max(inicio_calculo_base, inicio_apos_ferias)
+
+    # Ajustar por data de admissão (pega o maior entre início pós-férias e admissão)
+    if pd.notna(data_admissao):
+        inicio_calculo = max(inicio_calculo_base, data_admissao)
+    else:
+        inicio_calculo = inicio_calculo_base
+
+    # Ajustar por data de demissão
+    if pd.notna(data_demissao):
+        if comunicado_ok and data_demissao.day <= 15 and data_demissao.month == mes_referencia:
+            return 0  # Não paga nada
+        fim_calculo = min(data_demissao, mes_fim)
+
+    # Validação final do período
+    if inicio_calculo > fim_calculo:
+        return 0
+
+    dias_uteis = np.busday_count(
+        inicio_calculo.strftime('%Y-%m-%d'),
+        (fim_calculo + pd.Timedelta(days=1)).strftime('%Y-%m-%d'),
+        holidays=[f.strftime('%Y-%m-%d') for f in feriados_periodo]
+    )
+
+    # A LÓGICA DE SUBTRAÇÃO NO FINAL FOI REMOVIDA
+    return int(max(0, dias_uteis))
+
+def calcular_dias_a_pagar(df, **periodo):
+    """Aplica `calcular_dias_trabalhados` a cada funcionário (Passo 6)."""
+    return df.apply(calcular_dias_trabalhados, axis=1, **periodo)
+
+def calcular_matriz_dias(df, periodos, competencia_ferias=None):
+    """
+    Calcula os dias a pagar de todos os funcionários para várias competências de uma vez,
+    com a mesma regra do cálculo dinâmico do Passo 6, mas vetorizada.
+    `periodos` é {(ano, mês): (mes_inicio, mes_fim, feriados_periodo)}; os DIAS DE FÉRIAS
+    só são descontados em `competencia_ferias` (ano, mês).
+    Retorna um DataFrame (funcionário × competência 'MM/AAAA') com o mesmo índice de `df`.
+    """
+    sem_data = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+    data_admissao = pd.to_datetime(df['Admissão'], errors='coerce') if 'Admissão' in df.columns else sem_data
+    data_demissao = pd.to_datetime(df['DATA DEMISSÃO'], errors='coerce') if 'DATA DEMISSÃO' in df.columns else sem_data
+    if 'COMUNICADO DE DESLIGAMENTO' in df.columns:
+        comunicado_ok = df['COMUNICADO DE DESLIGAMENTO'].astype(str).str.strip().str.upper() == 'OK'
+    else:
+        comunicado_ok = pd.Series(False, index=df.index)
+    if 'DIAS DE FÉRIAS' in df.columns:
+        dias_ferias = pd.to_numeric(df['DIAS DE FÉRIAS'], errors='coerce').fillna(0)
+    else:
+        dias_ferias = pd.Series(0.0, index=df.index)
+    deslocamento_ferias = pd.to_timedelta(dias_ferias.where(dias_ferias > 0, 0), unit='D')
+    sem_ferias = pd.to_timedelta(pd.Series(0.0, index=df.index), unit='D')
+
+    matriz = {}
+    for (ano_referencia, mes_referencia), (mes_inicio, mes_fim, feriados_periodo) in periodos.items():
+        # Início: maior entre o dia seguinte ao fim das férias e a admissão
+        ferias = deslocamento_ferias if (ano_referencia, mes_referencia) == competencia_ferias else sem_ferias
+        inicio_calculo_base = mes_inicio + ferias
+        inicio_calculo = data_admissao.where(data_admissao > inicio_calculo_base, inicio_calculo_base)
+
+        # Fim: menor entre a demissão e o fim do mês
+        fim_calculo = data_demissao.where(data_demissao <= mes_fim, mes_fim)
+
+        # Desligados até dia 15 do próprio mês com comunicado OK não recebem nada
+        nao_paga = (comunicado_ok & (data_demissao.dt.day <= 15) & (data_demissao.dt.month == mes_referencia)
+                    & (data_demissao.dt.year == ano_referencia))
+
+        dias_uteis = np.busday_count(
+            inicio_calculo.to_numpy().astype('datetime64[D]'),
+            (fim_calculo + pd.Timedelta(days=1)).to_numpy().astype('datetime64[D]'),
+            holidays=[f.strftime('%Y-%m-%d') for f in feriados_periodo]
+        )
+        dias_uteis = np.where(nao_paga.to_numpy() | (inicio_calculo > fim_calculo).to_numpy(), 0, np.maximum(dias_uteis, 0))
+        matriz[f"{mes_referencia:02d}/{ano_referencia}"] = dias_uteis
+
+    return pd.DataFrame(matriz, index=df.index)
+
+def mapear_sindicato_estado(sindicato_text):
+    """Mapeia o texto do sindicato para o estado usado na tabela de valores."""
+    if not isinstance(sindicato_text, str): return 'São Paulo'
+    sindicato_upper = sindicato_text.upper()
+    if 'SP' in sindicato_upper or 'SÃO PAULO' in sindicato_upper: return 'São Paulo'
+    elif 'RJ' in sindicato_upper or 'RIO DE JANEIRO' in sindicato_upper: return 'Rio de Janeiro'
+    elif 'RS' in sindicato_upper or 'RIO GRANDE DO SUL' in sindicato_upper: return 'Rio Grande do Sul'
+    elif 'PR' in sindicato_upper or 'PARANÁ' in sindicato_upper: return 'Paraná'
+    else: return 'São Paulo'
+
+# Sindicato atribuído a quem não tem sindicato informado
+SINDICATO_PADRAO = 'SINDPD SP - SIND.TRAB.EM PROC DADOS E EMPR.EMP...'
+
+def anexar_valor_diario(df_elegiveis, df_valores):
+    """Atribui estado e valor diário a cada funcionário (Passo 8, sem os totais)."""
+    df_final = df_elegiveis.copy()
+    df_final['sindicato_ausente'] = df_final['Sindicato'].isna()
+    df_final['Sindicato'] = df_final['Sindicato'].fillna(SINDICATO_PADRAO)
+    df_final['Estado'] = df_final['Sindicato'].apply(mapear_sindicato_estado)
+    df_final = pd.merge(df_final, df_valores, on='Estado', how='left')
+    df_final['VALOR DIÁRIO VR'] = df_final['VALOR DIÁRIO VR'].fillna(0)
+    return df_final
+
+def calcular_totais(df_final):
+    """Calcula total, custo empresa (80%) e desconto profissional (20%)."""
+    df_final['TOTAL'] = df_final['Dias_A_Pagar'] * df_final['VALOR DIÁRIO VR']
+    df_final['Custo empresa'] = df_final['TOTAL'] * 0.80
+    df_final['Desconto profissional'] = df_final['TOTAL'] * 0.20
+    return df_final
+
+def _anexar_observacao(obs, mascara, texto):
+    """Acrescenta `texto` (str ou série) às observações das linhas marcadas, separado por '; '."""
+    separador = pd.Series(np.where(obs != '', '; ', ''), index=obs.index, dtype=object)
+    return obs.where(~mascara, obs + separador + texto)
+
+def gerar_observacoes(df_final):
+    """
+    Preenche a coluna 'OBS GERAL' de todos os funcionários, combinando, nesta ordem:
+    sindicato ausente, valor diário zerado, desligado até dia 15 com comunicado OK e
+    a observação da IA.
+    """
+    obs = pd.Series('', index=df_final.index, dtype=object)
+    if df_final.empty:
+        df_final['OBS GERAL'] = obs
+        return df_final
+
+    obs = _anexar_observacao(obs, df_final['sindicato_ausente'].astype(bool), 'Sindicato não informado; atribuído SP por padrão')
+    obs = _anexar_observacao(obs, df_final['VALOR DIÁRIO VR'] == 0, 'Valor diário não encontrado para o estado')
+
+    if 'DATA DEMISSÃO' in df_final.columns:
+        comunicado = df_final['COMUNICADO DE DESLIGAMENTO'] if 'COMUNICADO DE DESLIGAMENTO' in df_final.columns else pd.Series('', index=df_final.index)
+        desligado_com_comunicado = (
+            (df_final['Dias_A_Pagar'] == 0)
+            & df_final['DATA DEMISSÃO'].notna()
+            & (comunicado.astype(str).str.strip().str.upper() == 'OK')
+        )
+        obs = _anexar_observacao(obs, desligado_com_comunicado, 'Desligado até dia 15 com comunicado OK')
+
+    if 'Observacao_IA' in df_final.columns:
+        obs_ia = df_final['Observacao_IA'].fillna('').astype(str)
+        obs = _anexar_observacao(obs, obs_ia.str.strip() != '', obs_ia)
+
+    df_final['OBS GERAL'] = obs
+    return df_final
+
+def valorar_e_observar(df_elegiveis, df_valores):
+    """Passo 8 completo mais as observações do Passo 9."""
+    return gerar_observacoes(calcular_totais(anexar_valor_diario(df_elegiveis, df_valores)))
+
+# =====================================================================================
+# PRÉ-FILTRO DE ANOMALIAS EM RELAÇÃO À COMPETÊNCIA ANTERIOR
+# Os desvios de cada funcionário são medidos contra o desvio típico do mês (mediana e
+# MAD), para que uma mudança que atinge todos, como um mês com mais dias úteis, não
+# conte como anomalia.
+# =====================================================================================
+
+# Pontuação a partir da qual o funcionário é considerado atípico (escore z robusto)
+LIMIAR_ANOMALIA = 3.5
+
+def _chave_matricula(matriculas):
+    """Matrícula como texto, sem o '.0' de colunas lidas como float, para o join."""
+    return matriculas.astype(str).str.strip().str.replace(r'\.0$', '', regex=True)
+
+def _desvio_robusto(delta, escala_minima):
+    """|delta - mediana| em unidades de MAD, com uma escala mínima; NaN (sem histórico) vira 0."""
+    mediana = delta.median()
+    mad = (delta - mediana).abs().median()
+    escala = max(1.4826 * mad, escala_minima) if pd.notna(mad) else escala_minima
+    return ((delta - mediana).abs() / escala).fillna(0)
+
+def pontuar_anomalias(df_atual, df_anterior, df_valores, limiar=LIMIAR_ANOMALIA):
+    """
+    Compara cada funcionário com o resultado gravado da competência anterior (join pela
+    matrícula) e pontua os desvios de dias, de valor e a troca de sindicato.
+    `df_atual` precisa de MATRICULA, Sindicato e Dias_A_Pagar; `df_anterior`, das colunas
+    matricula, sindicato, dias e total do histórico. `limiar` é a pontuação a partir da
+    qual um desvio entra no motivo (e a pontuação mínima de quem trocou de sindicato).
+    Retorna um DataFrame com o índice de `df_atual` e as colunas 'Pontuacao_Anomalia',
+    'Tem_Historico' e 'Motivo_Anomalia'.
+    """
+    anterior = df_anterior.assign(_chave=_chave_matricula(df_anterior['matricula']), _existe=True)
+    anterior = anterior.drop_duplicates('_chave', keep='last').set_index('_chave')
+    anterior = anterior.reindex(_chave_matricula(df_atual['MATRICULA']).to_numpy())
+    anterior.index = df_atual.index
+    tem_historico = anterior['_existe'].notna()
+
+    # Valor do mês atual estimado como no Passo 8
+    sindicato_atual = df_atual['Sindicato'].fillna(SINDICATO_PADRAO)
+    valores_por_estado = df_valores.drop_duplicates('Estado', keep='last').set_index('Estado')['VALOR DIÁRIO VR']
+    valor_diario = sindicato_atual.map(mapear_sindicato_estado).map(valores_por_estado).fillna(0)
+    dias_atual = pd.to_numeric(df_atual['Dias_A_Pagar'], errors='coerce')
+    total_atual = dias_atual * valor_diario
+
+    valor_tipico = valor_diario[valor_diario > 0].median()
+    desvio_dias = _desvio_robusto((dias_atual - anterior['dias']).where(tem_historico), 1.0)
+    desvio_valor = _desvio_robusto((total_atual - anterior['total']).where(tem_historico), valor_tipico if pd.notna(valor_tipico) else 1.0)
+    trocou_sindicato = tem_historico & (
+        sindicato_atual.astype(str).str.strip().str.upper() != anterior['sindicato'].astype(str).str.strip().str.upper()
+    )
+
+    # A troca de sindicato sozinha já basta para o caso ir para a IA
+    pontuacao = np.maximum(desvio_dias, desvio_valor)
+    pontuacao = pontuacao.where(~trocou_sindicato, pontuacao.clip(lower=limiar))
+
+    motivo = pd.Series('', index=df_atual.index, dtype=object)
+    dias_anteriores = anterior['dias'].fillna(0).astype(int).astype(str)
+    motivo = motivo.where(desvio_dias < limiar,
+                          motivo + 'Dias atípicos em relação ao mês anterior (' + dias_anteriores + ' → ' + dias_atual.fillna(0).astype(int).astype(str) + '); ')
+    motivo = motivo.where(desvio_valor < limiar,
+                          motivo + 'Valor atípico em relação ao mês anterior (R$ ' + anterior['total'].fillna(0).round(2).astype(str)
+                          + ' → R$ ' + total_atual.round(2).astype(str) + '); ')
+    motivo = motivo.where(~trocou_sindicato, motivo + 'Troca de sindicato em relação ao mês anterior; ')
+
+    return pd.DataFrame({
+        'Pontuacao_Anomalia': pontuacao,
+        'Tem_Historico': tem_historico,
+        'Motivo_Anomalia': motivo,
+    })
+
+def identificar_casos_especiais(df, mes_referencia, ano_referencia, anomalias=None, limiar=LIMIAR_ANOMALIA, somente_atipicos=True):
+    """
+    Usa lógica de pandas para identificar rapidamente funcionários que
+    precisam de uma análise mais detalhada da IA.
+    Se `anomalias` (de `pontuar_anomalias`) for informado, vão para a IA os funcionários
+    com pontuação a partir de `limiar` e os casos das regras sem histórico para comparar;
+    os casos das regras cuja variação em relação ao mês anterior está dentro do normal
+    ficam de fora. Com `somente_atipicos=False`, todos os casos das regras seguem, junto
+    com os atípicos.
+    Retorna o DataFrame com uma nova coluna 'Motivo_Analise_IA'.
+    """
+    df['Motivo_Analise_IA'] = ''
+    
+    # Regra 1: Pagamento zerado (excluindo demitidos na 1a quinzena)
+    demitido_1a_quinzena = (pd.to_datetime(df.get('DATA DEMISSÃO')).dt.month == mes_referencia) & \
+                           (pd.to_datetime(df.get('DATA DEMISSÃO')).dt.day <= 15) & \
+                           (df.get('COMUNICADO DE DESLIGAMENTO', '').str.upper() == 'OK')
+                           
+    pagamento_zerado_injustificado = (df['Dias_A_Pagar'] == 0) & (~demitido_1a_quinzena)
+    df.loc[pagamento_zerado_injustificado, 'Motivo_Analise_IA'] += 'Pagamento zerado; '
+
+    # Regra 2: Admitidos no mês de referência
+    admitidos_no_mes = (pd.to_datetime(df.get('Admissão')).dt.month == mes_referencia) & \
+                       (pd.to_datetime(df.get('Admissão')).dt.year == ano_referencia)
+    df.loc[admitidos_no_mes, 'Motivo_Analise_IA'] += 'Admissão recente; '
+    
+    # Regra 3: Desligados no mês de referência
+    desligados_no_mes = (pd.to_datetime(df.get('DATA DEMISSÃO')).dt.month == mes_referencia) & \
+                        (pd.to_datetime(df.get('DATA DEMISSÃO')).dt.year == ano_referencia)
+    df.loc[desligados_no_mes, 'Motivo_Analise_IA'] += 'Desligamento recente; '
+    
+    # Regra 4: Dados importantes ausentes que afetam o cálculo
+    if 'sindicato_ausente' in df.columns and df['sindicato_ausente'].any():
+        df.loc[df['sindicato_ausente'], 'Motivo_Analise_IA'] += 'Sindicato ausente; '
+        
+    if 'VALOR DIÁRIO VR' in df.columns and (df['VALOR DIÁRIO VR'] == 0).any():
+        df.loc[df['VALOR DIÁRIO VR'] == 0, 'Motivo_Analise_IA'] += 'Valor diário zerado; '
+
+    # Pré-filtro estatístico: os casos das regras com variação normal em relação ao mês
+    # anterior não precisam da IA; os atípicos vão mesmo sem cair em nenhuma regra
+    if anomalias is not None:
+        atipicos = anomalias['Pontuacao_Anomalia'] >= limiar
+        casos_das_regras = df['Motivo_Analise_IA'] != ''
+        if somente_atipicos:
+            casos_das_regras &= ~anomalias['Tem_Historico']
+        df['Motivo_Analise_IA'] = (anomalias['Motivo_Anomalia'] + df['Motivo_Analise_IA']).where(atipicos | casos_das_regras, '')
+
+    return df
+
+# =====================================================================================
+# EXECUTOR PARALELO PARTICIONADO
+# =====================================================================================
+
+# Abaixo deste número de funcionários o custo de subir os processos não compensa
+LIMIAR_PARALELO = 100_000
+
+def definir_numero_processos(total_linhas, processos_maximos=None):
+    """Retorna quantos processos usar para uma base com `total_linhas` registros (1 = sequencial)."""
+    processos_maximos = processos_maximos or os.cpu_count() or 1
+    if total_linhas < LIMIAR_PARALELO:
+        return 1
+    return max(1, min(processos_maximos, total_linhas // (LIMIAR_PARALELO // 2)))
+
+def _estagio_dias(particao, **periodo):
+    """Estágio do executor: devolve só a ordem original e os dias calculados."""
+    return pd.DataFrame({
+        '_ordem': particao['_ordem'],
+        'Dias_A_Pagar': calcular_dias_a_pagar(particao.drop(columns='_ordem'), **periodo),
+    })
+
+def executar_em_paralelo(df, estagio, n_processos, chave='MATRICULA', **parametros):
+    """
+    Particiona `df` pelo hash da coluna `chave`, aplica `estagio(particao, **parametros)`
+    num pool de processos e junta as partições de volta na ordem original das linhas.
+    O estágio precisa ser uma função de nível de módulo e manter a coluna '_ordem'.
+    """
+    if chave not in df.columns:
+        chave = 'MATRICULA'
+    df = df.assign(_ordem=np.arange(len(df)))
+    grupos = pd.util.hash_pandas_object(df[chave].astype(str), index=False).to_numpy() % n_processos
+    particoes = [df[grupos == i] for i in range(n_processos)]
+    particoes = [particao for particao in particoes if not particao.empty]
+
+    contexto = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=len(particoes), mp_context=contexto) as pool:
+        resultados = list(pool.map(partial(estagio, **parametros), particoes))
+
+    resultado = pd.concat(resultados).sort_values('_ordem', kind='stable')
+    return resultado.drop(columns='_ordem')
+
+def calcular_dias_particionado(df, n_processos, chave='MATRICULA', **periodo):
+    """Passo 6 em paralelo. Retorna a série de dias com o mesmo índice de `df`."""
+    if n_processos <= 1 or df.empty:
+        return calcular_dias_a_pagar(df, **periodo)
+    colunas = [col for col in ['MATRICULA', 'Sindicato', 'Admissão', 'DATA DEMISSÃO', 'COMUNICADO DE DESLIGAMENTO', 'DIAS DE FÉRIAS'] if col in df.columns]
+    if chave not in colunas:
+        chave = 'MATRICULA'
+    resultado = executar_em_paralelo(df[colunas], _estagio_dias, n_processos, chave=chave, **periodo)
+    return pd.Series(resultado['Dias_A_Pagar'].to_numpy(), index=df.index)
+
+def valorar_e_observar_particionado(df_elegiveis, df_valores, n_processos, chave='MATRICULA'):
+    """Passos 8 e observações do 9 em paralelo, com o mesmo resultado da versão sequencial."""
+    if n_processos <= 1 or df_elegiveis.empty:
+        return valorar_e_observar(df_elegiveis, df_valores)
+    resultado = executar_em_paralelo(df_elegiveis, valorar_e_observar, n_processos, chave=chave, df_valores=df_valores)
+    return resultado.reset_index(drop=True)
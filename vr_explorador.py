@@ -0,0 +1,139 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# =====================================================================================
+# EXPLORADOR PAGINADO DO RESULTADO FINAL
+# O resultado é convertido uma única vez para uma tabela Arrow; filtros, ordenação e
+# paginação rodam sobre ela e só a página pedida volta para o pandas (e para o
+# navegador). Métricas e a distribuição por estado também são calculadas uma vez.
+# =====================================================================================
+
+COLUNA_ESTADO = 'Estado'
+TAMANHOS_PAGINA = [25, 50, 100, 250]
+# Colunas de data formatadas como texto no layout final: ordenadas pela data, não pelo texto
+COLUNAS_DATA = {'Admissão': '%d/%m/%Y'}
+PREFIXO_ORDEM = '_ordem_'
+
+def extrair_estado(sindicatos):
+    """Estado usado na análise, a partir do texto do sindicato (vetorizado)."""
+    texto = sindicatos.astype(str).str.upper()
+    estados = np.select(
+        [sindicatos.isna(), texto.str.contains('SP', regex=False), texto.str.contains('RJ', regex=False),
+         texto.str.contains('RS', regex=False), texto.str.contains('PR', regex=False)],
+        ['Não informado', 'São Paulo', 'Rio de Janeiro', 'Rio Grande do Sul', 'Paraná'],
+        default='Outros'
+    )
+    return pd.Series(estados, index=sindicatos.index)
+
+def _para_arrow(df):
+    """Converte para Arrow; colunas de texto com tipos misturados viram texto."""
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowException, TypeError, ValueError):
+        colunas_texto = {col: 'string' for col in df.columns[df.dtypes == object]}
+        return pa.Table.from_pandas(df.astype(colunas_texto), preserve_index=False)
+
+class ExploradorResultado:
+    """
+    Visão paginada de um `RESULTADO_FINAL`. Guarda as últimas consultas (filtro e
+    ordenação) para que trocar de página não refaça o filtro sobre a tabela inteira.
+    """
+    def __init__(self, resultado_final_df, max_consultas=8):
+        self.colunas = list(resultado_final_df.columns)
+        self.total_linhas = len(resultado_final_df)
+
+        df = resultado_final_df
+        if 'Sindicato do Colaborador' in df.columns:
+            df = df.assign(**{COLUNA_ESTADO: extrair_estado(df['Sindicato do Colaborador'])})
+        chaves_ordem = {f"{PREFIXO_ORDEM}{col}": pd.to_datetime(df[col], format=formato, errors='coerce')
+                        for col, formato in COLUNAS_DATA.items() if col in df.columns}
+        self.tabela = _para_arrow(df.assign(**chaves_ordem))
+
+        self.metricas = {
+            'funcionarios': self.total_linhas,
+            'total': float(resultado_final_df['TOTAL'].sum()),
+            'custo_empresa': float(resultado_final_df['Custo empresa'].sum()),
+            'desconto': float(resultado_final_df['Desconto profissional'].sum()),
+            'com_observacao': int((resultado_final_df['OBS GERAL'].fillna('').str.len() > 0).sum()),
+        }
+        if COLUNA_ESTADO in df.columns:
+            self.por_estado = df.groupby(COLUNA_ESTADO).agg(
+                Funcionários=('Matricula', 'count'), **{'Valor Total': ('TOTAL', 'sum')}
+            )
+        else:
+            self.por_estado = None
+        self.estados = sorted(self.por_estado.index) if self.por_estado is not None else []
+
+        self._max_consultas = max_consultas
+        self._consultas = {}
+        self._lock = threading.Lock()
+
+    def _mascara(self, busca, estados, somente_com_obs):
+        mascara = None
+        def combinar(atual, nova):
+            return nova if atual is None else pc.and_(atual, nova)
+
+        if busca:
+            termo = busca.strip()
+            colunas_busca = [pc.cast(self.tabela['Matricula'], pa.string())]
+            colunas_busca += [self.tabela[col] for col in ['Sindicato do Colaborador', 'OBS GERAL'] if col in self.colunas]
+            encontrado = None
+            for coluna in colunas_busca:
+                achou = pc.fill_null(pc.match_substring(coluna, termo, ignore_case=True), False)
+                encontrado = achou if encontrado is None else pc.or_(encontrado, achou)
+            mascara = combinar(mascara, encontrado)
+        if estados and COLUNA_ESTADO in self.tabela.column_names:
+            mascara = combinar(mascara, pc.is_in(self.tabela[COLUNA_ESTADO], value_set=pa.array(list(estados))))
+        if somente_com_obs:
+            mascara = combinar(mascara, pc.fill_null(pc.greater(pc.utf8_length(self.tabela['OBS GERAL']), 0), False))
+        if isinstance(mascara, pa.ChunkedArray):
+            mascara = mascara.combine_chunks()
+        return mascara
+
+    def _indices(self, busca, estados, somente_com_obs, ordenar_por, decrescente):
+        """Índices das linhas que passam no filtro, já na ordem pedida."""
+        chave = (busca.strip(), tuple(sorted(estados)), somente_com_obs, ordenar_por, decrescente)
+        with self._lock:
+            if chave in self._consultas:
+                return self._consultas[chave]
+
+        mascara = self._mascara(*chave[:3])
+        indices = pa.array(np.arange(self.total_linhas))
+        if mascara is not None:
+            indices = pc.filter(indices, mascara)
+        if ordenar_por in self.colunas:
+            coluna_ordem = f"{PREFIXO_ORDEM}{ordenar_por}"
+            if coluna_ordem not in self.tabela.column_names:
+                coluna_ordem = ordenar_por
+            valores = pc.take(self.tabela[coluna_ordem], indices)
+            ordem = pc.array_sort_indices(valores, order='descending' if decrescente else 'ascending')
+            indices = pc.take(indices, ordem)
+
+        with self._lock:
+            if len(self._consultas) >= self._max_consultas:
+                self._consultas.pop(next(iter(self._consultas)))
+            self._consultas[chave] = indices
+        return indices
+
+    def contar(self, busca='', estados=(), somente_com_obs=False, ordenar_por=None, decrescente=False):
+        """Total de linhas que passam no filtro."""
+        return len(self._indices(busca or '', estados or (), somente_com_obs, ordenar_por, decrescente))
+
+    def consultar(self, busca='', estados=(), somente_com_obs=False, ordenar_por=None, decrescente=False,
+                  pagina=1, tamanho_pagina=50, colunas=None):
+        """
+        Retorna (DataFrame da página, total de linhas filtradas). `busca` procura na
+        matrícula, no sindicato e nas observações; `pagina` começa em 1.
+        """
+        indices = self._indices(busca or '', estados or (), somente_com_obs, ordenar_por, decrescente)
+        inicio = (max(1, pagina) - 1) * tamanho_pagina
+        pagina_tabela = self.tabela.select(colunas or self.colunas).take(indices[inicio:inicio + tamanho_pagina])
+        return pagina_tabela.to_pandas(), len(indices)
+
+    def para_pandas(self):
+        """Resultado completo, sem a coluna auxiliar de estado (usado só para gerar a planilha)."""
+        return self.tabela.select(self.colunas).to_pandas()
@@ -0,0 +1,276 @@
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from vr_explorador import extrair_estado
+
+# =====================================================================================
+# HISTÓRICO DE RESULTADOS POR COMPETÊNCIA
+# Cada cálculo concluído é gravado num SQLite local, com chave (competência, matrícula).
+# Sindicatos e estados ficam em tabelas de rótulos e as linhas só guardam o id; os
+# totais por estado e sindicato são consolidados na gravação, para que as consultas
+# de resumo não precisem varrer as linhas dos funcionários.
+# =====================================================================================
+
+# Origem das competências gravadas pelo cálculo em lote: sem férias fora da competência
+# de referência, sem a planilha de dias úteis e sem a análise com IA
+ORIGEM_LOTE = 'lote'
+
+def codigo_competencia(ano, mes):
+    """Competência como inteiro AAAAMM, usado como chave no banco."""
+    return ano * 100 + mes
+
+def rotulo_competencia(codigo):
+    """AAAAMM -> 'MM/AAAA'."""
+    return f"{codigo % 100:02d}/{codigo // 100}"
+
+def competencia_anterior(codigo):
+    ano, mes = divmod(codigo, 100)
+    return codigo_competencia(ano - 1, 12) if mes == 1 else codigo_competencia(ano, mes - 1)
+
+def _normalizar_matricula(matricula):
+    """Matrículas numéricas são gravadas como inteiro; as demais, como texto."""
+    texto = str(matricula).strip()
+    if texto.endswith('.0'):
+        texto = texto[:-2]
+    return int(texto) if texto.isdigit() else texto
+
+def _normalizar_matriculas(matriculas):
+    """`_normalizar_matricula` para a coluna inteira; o caso comum (tudo numérico) é vetorizado."""
+    numericas = pd.to_numeric(matriculas, errors='coerce')
+    if numericas.notna().all() and (numericas % 1 == 0).all():
+        return numericas.astype('int64')
+    return matriculas.map(_normalizar_matricula)
+
+class HistoricoResultados:
+    """
+    Guarda o `RESULTADO_FINAL` de cada competência e responde às consultas de histórico
+    por funcionário, totais por estado/sindicato e variação entre meses.
+    Gravar de novo uma competência substitui o resultado anterior dela, exceto quando um
+    cálculo em lote tentaria substituir uma competência gravada por um cálculo normal.
+    """
+    def __init__(self, diretorio):
+        self.diretorio = Path(diretorio)
+        self.diretorio.mkdir(parents=True, exist_ok=True)
+        self.caminho_db = self.diretorio / 'historico.sqlite3'
+        self._lock = threading.Lock()
+        self._criar_tabelas()
+
+    def _conectar(self):
+        conexao = sqlite3.connect(self.caminho_db, timeout=30)
+        conexao.row_factory = sqlite3.Row
+        return conexao
+
+    def _criar_tabelas(self):
+        # closing fecha a conexão; o segundo `conexao` faz o commit (ou rollback)
+        with self._lock, closing(self._conectar()) as conexao, conexao:
+            conexao.execute("PRAGMA journal_mode=WAL")
+            conexao.execute("CREATE TABLE IF NOT EXISTS sindicatos (id INTEGER PRIMARY KEY, nome TEXT UNIQUE)")
+            conexao.execute("CREATE TABLE IF NOT EXISTS estados (id INTEGER PRIMARY KEY, nome TEXT UNIQUE)")
+            conexao.execute("""
+                CREATE TABLE IF NOT EXISTS competencias (
+                    competencia INTEGER PRIMARY KEY,
+                    origem TEXT,
+                    funcionarios INTEGER,
+                    total REAL,
+                    gravado_em TEXT
+                )""")
+            conexao.execute("""
+                CREATE TABLE IF NOT EXISTS resultados (
+                    competencia INTEGER NOT NULL,
+                    matricula INTEGER NOT NULL,
+                    sindicato_id INTEGER,
+                    estado_id INTEGER,
+                    admissao TEXT,
+                    dias INTEGER,
+                    valor_diario REAL,
+                    total REAL,
+                    custo_empresa REAL,
+                    desconto REAL,
+                    obs TEXT,
+                    PRIMARY KEY (competencia, matricula)
+                ) WITHOUT ROWID""")
+            conexao.execute("CREATE INDEX IF NOT EXISTS idx_resultados_matricula ON resultados (matricula, competencia)")
+            conexao.execute("""
+                CREATE TABLE IF NOT EXISTS totais (
+                    competencia INTEGER NOT NULL,
+                    estado_id INTEGER,
+                    sindicato_id INTEGER,
+                    funcionarios INTEGER,
+                    dias INTEGER,
+                    total REAL,
+                    custo_empresa REAL,
+                    desconto REAL
+                )""")
+            conexao.execute("CREATE INDEX IF NOT EXISTS idx_totais_competencia ON totais (competencia)")
+
+    def _ids_rotulos(self, conexao, tabela, nomes):
+        """Garante os rótulos na tabela `tabela` e retorna {nome: id}."""
+        nomes = [nome for nome in pd.unique(nomes) if pd.notna(nome)]
+        conexao.executemany(f"INSERT OR IGNORE INTO {tabela} (nome) VALUES (?)", [(nome,) for nome in nomes])
+        return {linha['nome']: linha['id'] for linha in conexao.execute(f"SELECT id, nome FROM {tabela}")}
+
+    def gravar(self, resultado_final_df, ano, mes, origem='sessao'):
+        """
+        Grava (ou substitui) o resultado final de uma competência. Com `origem` igual a
+        ORIGEM_LOTE, uma competência já gravada por outra origem é mantida e nada é
+        gravado. Retorna o número de funcionários gravados.
+        """
+        codigo = codigo_competencia(ano, mes)
+        df = resultado_final_df
+        sindicatos = df['Sindicato do Colaborador'].astype(object).where(df['Sindicato do Colaborador'].notna(), None)
+        estados = extrair_estado(df['Sindicato do Colaborador'])
+
+        with self._lock, closing(self._conectar()) as conexao, conexao:
+            # A verificação e a substituição ficam na mesma transação de escrita, também
+            # entre processos do servidor que usam o mesmo banco
+            conexao.execute("BEGIN IMMEDIATE")
+            if origem == ORIGEM_LOTE:
+                existente = conexao.execute("SELECT origem FROM competencias WHERE competencia = ?", (codigo,)).fetchone()
+                if existente is not None and existente['origem'] != ORIGEM_LOTE:
+                    return 0
+            ids_sindicato = self._ids_rotulos(conexao, 'sindicatos', sindicatos)
+            ids_estado = self._ids_rotulos(conexao, 'estados', estados)
+            linhas = pd.DataFrame({
+                'competencia': codigo,
+                'matricula': _normalizar_matriculas(df['Matricula']),
+                'sindicato_id': sindicatos.map(ids_sindicato),
+                'estado_id': estados.map(ids_estado),
+                'admissao': df['Admissão'] if 'Admissão' in df.columns else None,
+                'dias': df['Dias'],
+                'valor_diario': df['VALOR DIÁRIO VR'],
+                'total': df['TOTAL'],
+                'custo_empresa': df['Custo empresa'],
+                'desconto': df['Desconto profissional'],
+                'obs': df['OBS GERAL'],
+            })
+            linhas = linhas.drop_duplicates('matricula', keep='last')
+            linhas = linhas.astype(object).where(linhas.notna(), None)
+
+            conexao.execute("DELETE FROM resultados WHERE competencia = ?", (codigo,))
+            conexao.execute("DELETE FROM totais WHERE competencia = ?", (codigo,))
+            conexao.executemany(
+                f"INSERT INTO resultados ({', '.join(linhas.columns)}) VALUES ({', '.join('?' * len(linhas.columns))})",
+                linhas.itertuples(index=False, name=None)
+            )
+            conexao.execute("""
+                INSERT INTO totais
+                SELECT competencia, estado_id, sindicato_id, COUNT(*), SUM(dias), SUM(total), SUM(custo_empresa), SUM(desconto)
+                FROM resultados WHERE competencia = ?
+                GROUP BY estado_id, sindicato_id""", (codigo,))
+            conexao.execute(
+                "INSERT OR REPLACE INTO competencias VALUES (?, ?, ?, ?, ?)",
+                (codigo, origem, len(linhas), float(df['TOTAL'].sum()), datetime.now().isoformat(timespec='seconds'))
+            )
+        return len(linhas)
+
+    def _consultar(self, sql, parametros=()):
+        with closing(self._conectar()) as conexao:
+            return pd.read_sql_query(sql, conexao, params=parametros)
+
+    def competencias(self):
+        """Competências gravadas, da mais recente para a mais antiga."""
+        return self._consultar("SELECT * FROM competencias ORDER BY competencia DESC")
+
+    def resumo_mensal(self):
+        """Totais de cada competência com a variação em relação à competência anterior gravada."""
+        resumo = self._consultar("""
+            SELECT competencia, SUM(funcionarios) AS funcionarios, SUM(dias) AS dias, SUM(total) AS total,
+                   SUM(custo_empresa) AS custo_empresa, SUM(desconto) AS desconto
+            FROM totais GROUP BY competencia ORDER BY competencia""")
+        resumo['delta_funcionarios'] = resumo['funcionarios'].diff()
+        resumo['delta_total'] = resumo['total'].diff()
+        resumo['delta_total_pct'] = resumo['total'].pct_change() * 100
+        return resumo
+
+    def totais_por(self, agrupamento='estado', competencia_inicio=None, competencia_fim=None):
+        """Totais por competência e estado (ou sindicato), a partir da tabela consolidada."""
+        tabela = 'estados' if agrupamento == 'estado' else 'sindicatos'
+        coluna = 'estado_id' if agrupamento == 'estado' else 'sindicato_id'
+        return self._consultar(f"""
+            SELECT t.competencia, COALESCE(r.nome, 'Não informado') AS {agrupamento},
+                   SUM(t.funcionarios) AS funcionarios, SUM(t.total) AS total,
+                   SUM(t.custo_empresa) AS custo_empresa, SUM(t.desconto) AS desconto
+            FROM totais t LEFT JOIN {tabela} r ON r.id = t.{coluna}
+            WHERE t.competencia BETWEEN ? AND ?
+            GROUP BY t.competencia, {agrupamento}
+            ORDER BY t.competencia, {agrupamento}""",
+            (competencia_inicio or 0, competencia_fim or 999912))
+
+    def historico_funcionario(self, matricula, meses=12):
+        """Últimas `meses` competências de um funcionário, da mais antiga para a mais recente."""
+        historico = self._consultar("""
+            SELECT r.competencia, s.nome AS sindicato, e.nome AS estado, r.admissao, r.dias, r.valor_diario,
+                   r.total, r.custo_empresa, r.desconto, r.obs
+            FROM resultados r
+            LEFT JOIN sindicatos s ON s.id = r.sindicato_id
+            LEFT JOIN estados e ON e.id = r.estado_id
+            WHERE r.matricula = ?
+            ORDER BY r.competencia DESC LIMIT ?""", (_normalizar_matricula(matricula), meses))
+        return historico.iloc[::-1].reset_index(drop=True)
+
+    def resultado_competencia(self, codigo, colunas=('matricula', 'sindicato', 'dias', 'valor_diario', 'total'), incluir_lote=True):
+        """
+        Resultado gravado de uma competência (vazio se ela não existir, ou se tiver vindo
+        de um cálculo em lote e `incluir_lote` for False).
+        """
+        expressoes = {'matricula': 'r.matricula', 'sindicato': 's.nome AS sindicato', 'estado': 'e.nome AS estado',
+                      'admissao': 'r.admissao', 'dias': 'r.dias', 'valor_diario': 'r.valor_diario', 'total': 'r.total',
+                      'custo_empresa': 'r.custo_empresa', 'desconto': 'r.desconto', 'obs': 'r.obs'}
+        filtro_lote = '' if incluir_lote else f"""
+              AND NOT EXISTS (SELECT 1 FROM competencias c WHERE c.competencia = r.competencia AND c.origem = '{ORIGEM_LOTE}')"""
+        return self._consultar(f"""
+            SELECT {', '.join(expressoes[col] for col in colunas)}
+            FROM resultados r
+            LEFT JOIN sindicatos s ON s.id = r.sindicato_id
+            LEFT JOIN estados e ON e.id = r.estado_id
+            WHERE r.competencia = ?{filtro_lote}""", (codigo,))
+
+    def variacao_mensal(self, codigo, limite=500):
+        """
+        Diferenças por funcionário entre `codigo` e a competência anterior: dias, total e
+        troca de sindicato, incluindo quem entrou e quem saiu. Retorna (maiores variações
+        até `limite` linhas, contagem por tipo de variação).
+        """
+        codigo = int(codigo)
+        anterior = competencia_anterior(codigo)
+        variacoes = f"""
+            WITH juntos AS (
+                    -- Os dois lados usam a chave primária (competência, matrícula) da tabela
+                    SELECT a.matricula, p.sindicato_id AS sindicato_anterior, a.sindicato_id AS sindicato_atual,
+                           p.dias AS dias_anterior, a.dias AS dias_atual, p.total AS total_anterior, a.total AS total_atual
+                    FROM resultados a
+                    LEFT JOIN resultados p ON p.competencia = {anterior} AND p.matricula = a.matricula
+                    WHERE a.competencia = {codigo}
+                    UNION ALL
+                    SELECT p.matricula, p.sindicato_id, NULL, p.dias, NULL, p.total, NULL
+                    FROM resultados p
+                    WHERE p.competencia = {anterior} AND NOT EXISTS (
+                        SELECT 1 FROM resultados a WHERE a.competencia = {codigo} AND a.matricula = p.matricula
+                    )
+                 ),
+                 classificados AS (
+                    SELECT *, COALESCE(dias_atual, 0) - COALESCE(dias_anterior, 0) AS delta_dias,
+                           COALESCE(total_atual, 0) - COALESCE(total_anterior, 0) AS delta_total,
+                           CASE WHEN total_anterior IS NULL THEN 'Entrou'
+                                WHEN total_atual IS NULL THEN 'Saiu'
+                                WHEN sindicato_atual IS NOT sindicato_anterior THEN 'Trocou de sindicato'
+                                WHEN total_atual <> total_anterior OR dias_atual <> dias_anterior THEN 'Mudou'
+                                ELSE 'Igual' END AS variacao
+                    FROM juntos
+                 )"""
+        with closing(self._conectar()) as conexao:
+            contagem = pd.read_sql_query(f"{variacoes} SELECT variacao, COUNT(*) AS funcionarios, SUM(delta_total) AS delta_total FROM classificados GROUP BY variacao", conexao)
+            detalhes = pd.read_sql_query(f"""{variacoes}
+                SELECT c.matricula, c.variacao, sa.nome AS sindicato_anterior, sn.nome AS sindicato_atual,
+                       c.dias_anterior, c.dias_atual, c.delta_dias, c.total_anterior, c.total_atual, c.delta_total
+                FROM classificados c
+                LEFT JOIN sindicatos sa ON sa.id = c.sindicato_anterior
+                LEFT JOIN sindicatos sn ON sn.id = c.sindicato_atual
+                WHERE c.variacao <> 'Igual'
+                ORDER BY ABS(c.delta_total) DESC LIMIT ?""", conexao, params=(limite,))
+        return detalhes, contagem
@@ -0,0 +1,143 @@
+import os
+import time
+import importlib
+import threading
+from types import SimpleNamespace
+from typing import Optional
+
+# =====================================================================================
+# SUBSISTEMA DE IA (LANGCHAIN + GEMINI), CARREGADO SOB DEMANDA
+# Importar a pilha do LangChain é caro e a análise com IA vem desligada por padrão,
+# por isso nada aqui é importado até a primeira chamada de `carregar_ia`.
+# =====================================================================================
+
+# Tempo (s) gasto importando cada módulo da pilha de IA, para o painel de diagnóstico
+METRICAS_IMPORTACAO = {}
+
+_componentes = None
+_lock = threading.Lock()
+
+def _importar(nome_modulo):
+    inicio = time.perf_counter()
+    modulo = importlib.import_module(nome_modulo)
+    METRICAS_IMPORTACAO[nome_modulo] = time.perf_counter() - inicio
+    return modulo
+
+def ia_carregada():
+    return _componentes is not None
+
+def carregar_ia(api_key=None):
+    """
+    Importa e configura a pilha LangChain + Gemini na primeira chamada.
+    Nas chamadas seguintes devolve os componentes já carregados.
+    """
+    global _componentes
+    with _lock:
+        if _componentes is None:
+            if api_key:
+                os.environ.setdefault('GOOGLE_API_KEY', api_key)
+            genai = _importar('langchain_google_genai')
+            agents = _importar('langchain.agents')
+            hub = _importar('langchain.hub')
+            tools = _importar('langchain.tools')
+            callbacks = _importar('langchain_community.callbacks.streamlit')
+            _componentes = SimpleNamespace(
+                ChatGoogleGenerativeAI=genai.ChatGoogleGenerativeAI,
+                AgentExecutor=agents.AgentExecutor,
+                create_structured_chat_agent=agents.create_structured_chat_agent,
+                hub=hub,
+                tool=tools.tool,
+                StreamlitCallbackHandler=callbacks.StreamlitCallbackHandler,
+            )
+    return _componentes
+
+# =====================================================================================
+# FERRAMENTAS DO AGENTE DE IA
+# =====================================================================================
+
+def analisar_funcionario_ia(dados_funcionario: str, motivo_analise: str, notas_nao_estruturadas: Optional[str] = None) -> str:
+    """
+    Analisa dados de um funcionário que foi pré-selecionado como um caso especial.
+    Usa o motivo da análise e notas não estruturadas para gerar observações inteligentes.
+    """
+    try:
+        llm = carregar_ia().ChatGoogleGenerativeAI(
+            model="gemini-1.5-flash", 
+            temperature=0,
+            convert_system_message_to_human=True
+        )
+        
+        prompt = f"""
+        Você é um analista de RH especialista. Analise os dados de um funcionário que foi sinalizado como um caso especial.
+        Seu objetivo é gerar uma observação CONCISA e útil para a planilha de Vale Refeição.
+
+        **Motivo pelo qual este funcionário foi sinalizado para análise:**
+        {motivo_analise}
+
+        **Dados do Funcionário:**
+        {dados_funcionario}
+        """
+
+        if notas_nao_estruturadas and notas_nao_estruturadas.strip():
+            prompt += f"""
+        **Notas Manuais Encontradas na Planilha (informação crucial e não estruturada):**
+        "{notas_nao_estruturadas}"
+        """
+
+        prompt += """
+        **Sua Tarefa:**
+        Com base em TODAS as informações (motivo, dados e especialmente as notas manuais, se houver), gere uma observação curta (máximo 150 caracteres) que resuma a situação ou a ação necessária.
+        - Se as notas manuais explicarem o motivo (ex: "Pagamento zerado" e nota "Funcionário de licença"), use essa informação.
+        - Se não houver nada relevante a adicionar, retorne "SEM_OBSERVACAO".
+
+        Exemplos de boas observações:
+        - "Admissão em 15/05. Cálculo proporcional ok."
+        - "Pagamento zerado devido a licença não remunerada (ver nota)."
+        - "Desligado em 20/05. Comunicado OK. Pagamento proporcional."
+        - "Sindicato não localizado, valor padrão SP aplicado."
+        """
+        
+        response = llm.invoke(prompt)
+        observacao = response.content.strip()
+        
+        if len(observacao) > 150:
+            observacao = observacao[:147] + "..."
+            
+        return observacao if observacao != "SEM_OBSERVACAO" else ""
+        
+    except Exception as e:
+        return f"Erro na análise IA: {str(e)[:50]}"
+
+def executar_agente(processar_calculo_vr, tarefa, container):
+    """
+    Monta o agente Gemini com as ferramentas de cálculo e de análise e executa a tarefa,
+    mostrando o raciocínio do agente em `container`.
+    """
+    ia = carregar_ia()
+
+    # Configurar ferramentas e modelo
+    tools = [ia.tool(processar_calculo_vr), ia.tool(analisar_funcionario_ia)]
+    llm = ia.ChatGoogleGenerativeAI(
+        model="gemini-2.5-flash", 
+        temperature=0,
+        convert_system_message_to_human=True
+    )
+    
+    # Criar agente
+    prompt = ia.hub.pull("hwchase17/structured-chat-agent")
+    agent = ia.create_structured_chat_agent(llm, tools, prompt)
+    agent_executor = ia.AgentExecutor(
+        agent=agent, 
+        tools=tools, 
+        verbose=True, 
+        handle_parsing_errors=True,
+        max_iterations=3
+    )
+    
+    # Callback para mostrar progresso
+    st_callback = ia.StreamlitCallbackHandler(container, expand_new_thoughts=False)
+    
+    return agent_executor.invoke(
+        {"input": tarefa}, 
+        {"callbacks": [st_callback]}
+    )
@@ -0,0 +1,211 @@
+import json
+import sqlite3
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pandas as pd
+
+# =====================================================================================
+# FILA LOCAL DE CÁLCULOS EM SEGUNDO PLANO
+# Os jobs, o log de progresso e os resultados ficam gravados num SQLite local, para
+# que o usuário possa recarregar a página e reencontrar o job. Cada job pertence a um
+# dono (o token da sessão do navegador) e só é listado e aberto por ele.
+# =====================================================================================
+
+STATUS_NA_FILA = 'na_fila'
+STATUS_EXECUTANDO = 'executando'
+STATUS_CONCLUIDO = 'concluido'
+STATUS_ERRO = 'erro'
+STATUS_INTERROMPIDO = 'interrompido'
+STATUS_ATIVOS = (STATUS_NA_FILA, STATUS_EXECUTANDO)
+
+class FilaCheiaError(RuntimeError):
+    """Levantada quando já existem jobs demais aguardando execução."""
+
+class RelatorioJob:
+    """
+    Recebe as mensagens de progresso de um job com a mesma interface usada do `st`
+    (write, success, warning, error, info e progress) e grava tudo no banco do job.
+    """
+    def __init__(self, gerenciador, job_id):
+        self._gerenciador = gerenciador
+        self._job_id = job_id
+
+    def write(self, texto): self._gerenciador._registrar_evento(self._job_id, 'write', texto)
+    def success(self, texto): self._gerenciador._registrar_evento(self._job_id, 'success', texto)
+    def warning(self, texto): self._gerenciador._registrar_evento(self._job_id, 'warning', texto)
+    def error(self, texto): self._gerenciador._registrar_evento(self._job_id, 'error', texto)
+    def info(self, texto): self._gerenciador._registrar_evento(self._job_id, 'info', texto)
+
+    def progress(self, valor, text=None):
+        """Atualiza a barra de progresso do job. Retorna a si mesmo, como o `st.progress`."""
+        self._gerenciador._atualizar_job(self._job_id, progresso=float(valor), progresso_texto=text)
+        return self
+
+class GerenciadorJobs:
+    """
+    Executa funções de cálculo em threads de segundo plano com um limite global de
+    execuções simultâneas, compartilhado por todas as sessões do servidor.
+    A função recebe `saida=RelatorioJob` e deve retornar (DataFrame ou None, mensagem).
+    Jobs finalizados há mais de `retencao_dias` são apagados, com os seus resultados.
+    """
+    def __init__(self, diretorio, max_simultaneos=2, max_na_fila=8, retencao_dias=7):
+        self.diretorio = Path(diretorio)
+        self.diretorio.mkdir(parents=True, exist_ok=True)
+        self.caminho_db = self.diretorio / 'jobs.sqlite3'
+        self.max_simultaneos = max_simultaneos
+        self.max_na_fila = max_na_fila
+        self.retencao_dias = retencao_dias
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_simultaneos, thread_name_prefix='vr-job')
+        self._criar_tabelas()
+        self._marcar_interrompidos()
+        self.limpar_antigos()
+
+    def _conectar(self):
+        # Sem transação implícita: cada comando é gravado na hora, e as operações que
+        # precisam de mais de um comando abrem a sua própria transação
+        conexao = sqlite3.connect(self.caminho_db, timeout=30, isolation_level=None)
+        conexao.row_factory = sqlite3.Row
+        return conexao
+
+    def _criar_tabelas(self):
+        with self._lock, closing(self._conectar()) as conexao:
+            conexao.execute("PRAGMA journal_mode=WAL")
+            conexao.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    dono TEXT,
+                    descricao TEXT,
+                    metadados TEXT,
+                    status TEXT,
+                    progresso REAL DEFAULT 0,
+                    progresso_texto TEXT,
+                    mensagem TEXT,
+                    criado_em TEXT,
+                    iniciado_em TEXT,
+                    finalizado_em TEXT
+                )""")
+            # Bancos criados antes da coluna de dono
+            colunas = {linha['name'] for linha in conexao.execute("PRAGMA table_info(jobs)")}
+            if 'dono' not in colunas:
+                conexao.execute("ALTER TABLE jobs ADD COLUMN dono TEXT")
+            conexao.execute("CREATE INDEX IF NOT EXISTS idx_jobs_dono ON jobs (dono, criado_em)")
+            conexao.execute("""
+                CREATE TABLE IF NOT EXISTS eventos (
+                    job_id TEXT,
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tipo TEXT,
+                    texto TEXT
+                )""")
+            conexao.execute("CREATE INDEX IF NOT EXISTS idx_eventos_job ON eventos (job_id, seq)")
+
+    def _marcar_interrompidos(self):
+        """Jobs que estavam ativos quando o servidor parou não serão retomados."""
+        with self._lock, closing(self._conectar()) as conexao:
+            conexao.execute(
+                "UPDATE jobs SET status = ?, mensagem = 'Servidor reiniciado durante a execução.', finalizado_em = ? WHERE status IN (?, ?)",
+                (STATUS_INTERROMPIDO, datetime.now().isoformat(timespec='seconds'), *STATUS_ATIVOS)
+            )
+
+    def limpar_antigos(self):
+        """Apaga os jobs finalizados há mais de `retencao_dias`, o log e o resultado deles."""
+        limite = (datetime.now() - timedelta(days=self.retencao_dias)).isoformat(timespec='seconds')
+        with self._lock, closing(self._conectar()) as conexao:
+            conexao.execute("BEGIN IMMEDIATE")
+            antigos = [linha['id'] for linha in conexao.execute(
+                "SELECT id FROM jobs WHERE status NOT IN (?, ?) AND COALESCE(finalizado_em, criado_em) < ?",
+                (*STATUS_ATIVOS, limite)
+            )]
+            conexao.executemany("DELETE FROM eventos WHERE job_id = ?", [(job_id,) for job_id in antigos])
+            conexao.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in antigos])
+            conexao.execute("COMMIT")
+        for job_id in antigos:
+            self._caminho_resultado(job_id).unlink(missing_ok=True)
+        return len(antigos)
+
+    def _registrar_evento(self, job_id, tipo, texto):
+        with self._lock, closing(self._conectar()) as conexao:
+            conexao.execute("INSERT INTO eventos (job_id, tipo, texto) VALUES (?, ?, ?)", (job_id, tipo, str(texto)))
+
+    def _atualizar_job(self, job_id, **campos):
+        atribuicoes = ', '.join(f"{campo} = ?" for campo in campos)
+        with self._lock, closing(self._conectar()) as conexao:
+            conexao.execute(f"UPDATE jobs SET {atribuicoes} WHERE id = ?", (*campos.values(), job_id))
+
+    def _caminho_resultado(self, job_id):
+        return self.diretorio / f"{job_id}.pkl"
+
+    def contar_ativos(self):
+        with closing(self._conectar()) as conexao:
+            return conexao.execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", STATUS_ATIVOS).fetchone()[0]
+
+    def submeter(self, descricao, funcao, dono, metadados=None, **parametros):
+        """Coloca `funcao(saida=..., **parametros)` na fila em nome de `dono` e retorna o id do job."""
+        self.limpar_antigos()
+        job_id = uuid.uuid4().hex
+        with self._lock, closing(self._conectar()) as conexao:
+            # Contagem e inserção na mesma transação: duas sessões não passam juntas do limite
+            conexao.execute("BEGIN IMMEDIATE")
+            try:
+                ativos = conexao.execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", STATUS_ATIVOS).fetchone()[0]
+                if ativos >= self.max_simultaneos + self.max_na_fila:
+                    raise FilaCheiaError("Há cálculos demais em andamento no servidor. Tente novamente em alguns minutos.")
+                conexao.execute(
+                    "INSERT INTO jobs (id, dono, descricao, metadados, status, criado_em) VALUES (?, ?, ?, ?, ?, ?)",
+                    (job_id, dono, descricao, json.dumps(metadados or {}), STATUS_NA_FILA, datetime.now().isoformat(timespec='seconds'))
+                )
+                conexao.execute("COMMIT")
+            except Exception:
+                conexao.execute("ROLLBACK")
+                raise
+        self._pool.submit(self._executar, job_id, funcao, parametros)
+        return job_id
+
+    def _executar(self, job_id, funcao, parametros):
+        self._atualizar_job(job_id, status=STATUS_EXECUTANDO, iniciado_em=datetime.now().isoformat(timespec='seconds'))
+        relatorio = RelatorioJob(self, job_id)
+        try:
+            resultado, mensagem = funcao(saida=relatorio, **parametros)
+            if resultado is not None:
+                resultado.to_pickle(self._caminho_resultado(job_id))
+            status = STATUS_CONCLUIDO if resultado is not None else STATUS_ERRO
+        except Exception as e:
+            relatorio.error(f"❌ Erro durante o processamento: {e}")
+            status, mensagem = STATUS_ERRO, str(e)
+        self._atualizar_job(job_id, status=status, mensagem=mensagem, progresso=1.0,
+                            finalizado_em=datetime.now().isoformat(timespec='seconds'))
+
+    def obter(self, job_id, dono):
+        """Retorna os dados do job como dicionário, ou None se ele não existir ou for de outro dono."""
+        with closing(self._conectar()) as conexao:
+            linha = conexao.execute("SELECT * FROM jobs WHERE id = ? AND dono = ?", (job_id, dono)).fetchone()
+        if linha is None:
+            return None
+        job = dict(linha)
+        job['metadados'] = json.loads(job['metadados'] or '{}')
+        return job
+
+    def listar(self, dono, limite=10):
+        """Retorna os jobs mais recentes de `dono`."""
+        with closing(self._conectar()) as conexao:
+            linhas = conexao.execute("SELECT * FROM jobs WHERE dono = ? ORDER BY criado_em DESC LIMIT ?", (dono, limite)).fetchall()
+        return [dict(linha) for linha in linhas]
+
+    def eventos(self, job_id):
+        """Retorna o log do job como lista de (tipo, texto)."""
+        with closing(self._conectar()) as conexao:
+            linhas = conexao.execute("SELECT tipo, texto FROM eventos WHERE job_id = ? ORDER BY seq", (job_id,)).fetchall()
+        return [(linha['tipo'], linha['texto']) for linha in linhas]
+
+    def carregar_resultado(self, job_id):
+        """Lê o resultado gravado pelo job, ou None se ainda não houver. Confira o dono com `obter` antes."""
+        try:
+            return pd.read_pickle(self._caminho_resultado(job_id))
+        except FileNotFoundError:
+            # Sem resultado ainda, ou já apagado pela limpeza de jobs antigos
+            return None